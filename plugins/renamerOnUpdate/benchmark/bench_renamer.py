@@ -0,0 +1,205 @@
+"""Benchmark renamerOnUpdate.py against a local mock Stash.
+
+A synthetic library (make_library.py) is generated on tmpfs when possible, the
+plugin is copied in a temporary plugin folder with a benchmark config and run
+as Stash does (fragment on stdin) against mock_stash.py:
+
+    bulk_dry  task 'Rename scenes' in dry-run, only the templates
+    hook      the hook on --hooks scenes, each in a new process
+    bulk      task 'Rename scenes', the files are moved and the database updated
+
+For each scenario: scenes/sec, GraphQL requests per scene and peak RSS of the
+plugin process. After the real bulk, every file of the database must exist.
+
+    python bench_renamer.py [-n SCENES] [--hooks N] [--set "key = value" ...]
+    python bench_renamer.py --save baseline.json
+    python bench_renamer.py --compare baseline.json [--tolerance 0.2]
+
+--compare exits with 1 if a scenario is slower than the baseline by more than
+the tolerance, uses more requests per scene or more memory.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import make_library  # noqa: E402
+import mock_stash  # noqa: E402
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_FILES = ("renamerOnUpdate.py", "renamerOnUpdate_config.py", "renamerOnUpdate_template.py", "log.py", "renamerOnUpdate.yml")
+
+
+def work_directory(path=None):
+    if path:
+        os.makedirs(path, exist_ok=True)
+        return path, False
+    # tmpfs, the disk speed is not what is measured
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+    return tempfile.mkdtemp(prefix="renamer_bench_", dir=base), True
+
+
+def install_plugin(work, library, overrides):
+    plugin_dir = os.path.join(work, "plugin")
+    os.makedirs(plugin_dir, exist_ok=True)
+    for name in PLUGIN_FILES:
+        shutil.copy(os.path.join(PLUGIN_DIR, name), plugin_dir)
+    with open(os.path.join(plugin_dir, "renamerOnUpdate_config.py"), "a", encoding="utf-8") as f:
+        f.write("\n# benchmark\n")
+        f.write('use_default_template = True\ndefault_template = "$date $performer - $title [$studio]"\n')
+        f.write(f'p_use_default_template = True\np_default_template = r"{os.path.join(library, "$studio")}"\n')
+        f.write(f'log_file = r"{os.path.join(work, "rename_log.txt")}"\n')
+        f.write("dry_run = True\nenable_hook = True\nworker_mode = False\n")
+        for line in overrides:
+            f.write(line + "\n")
+    return plugin_dir
+
+
+def request_count(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return sum(json.loads(response.read()).values())
+
+
+def run_plugin(plugin_dir, port, args):
+    # returns (seconds, peak RSS in KiB, error lines)
+    fragment = {
+        "server_connection": {"Scheme": "http", "Host": "127.0.0.1", "Port": port, "SessionCookie": {"Value": ""}, "PluginDir": plugin_dir},
+        "args": args,
+    }
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(plugin_dir, "renamerOnUpdate.py")], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        process.stdin.write(json.dumps(fragment).encode())
+        process.stdin.close()
+        # rusage of this process only, not of all the children of the benchmark
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = status
+        stderr.seek(0)
+        errors = [line.decode(errors="replace").strip("\x01\x02\n") for line in stderr if line.startswith(b"\x01e")]
+    # ru_maxrss is in bytes on macOS
+    peak = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return elapsed, peak, errors
+
+
+def scenario(name, plugin_dir, port, runs, scenes):
+    requests = request_count(port)
+    elapsed = 0
+    peak = 0
+    errors = []
+    for args in runs:
+        seconds, rss, err = run_plugin(plugin_dir, port, args)
+        elapsed += seconds
+        peak = max(peak, rss)
+        errors.extend(err)
+    requests = request_count(port) - requests
+    for line in errors[:5]:
+        print(f"  [{name}] {line}")
+    return {
+        "scenes": scenes,
+        "seconds": round(elapsed, 3),
+        "scenes_per_sec": round(scenes / elapsed, 1),
+        "requests_per_scene": round(requests / scenes, 3),
+        "peak_rss_mib": round(peak / 1024, 1),
+        "errors": len(errors),
+    }
+
+
+def check_library(db_path):
+    # every file of the database is on the disk
+    db = sqlite3.connect(db_path)
+    missing = 0
+    for folder, basename in db.execute("SELECT folders.path, files.basename FROM files JOIN folders ON folders.id = files.parent_folder_id"):
+        if not os.path.isfile(os.path.join(folder, basename)):
+            missing += 1
+    db.close()
+    return missing
+
+
+def compare(results, baseline, tolerance):
+    failed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        speed = result["scenes_per_sec"] / max(base["scenes_per_sec"], 0.001) - 1
+        print(f"{name:<10} {speed:+.1%} scenes/sec, requests/scene {base['requests_per_scene']} -> {result['requests_per_scene']}, "
+              f"peak RSS {base['peak_rss_mib']} -> {result['peak_rss_mib']} MiB")
+        if speed < -tolerance:
+            failed.append(f"{name}: {speed:+.1%} scenes/sec")
+        if result["requests_per_scene"] > base["requests_per_scene"] + 0.001:
+            failed.append(f"{name}: more requests per scene")
+        if result["peak_rss_mib"] > base["peak_rss_mib"] * (1 + tolerance):
+            failed.append(f"{name}: peak RSS {result['peak_rss_mib']} MiB")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--scenes", type=int, default=2000)
+    parser.add_argument("--hooks", type=int, default=20, help="number of hook runs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--work", help="work directory (default: a temporary directory on /dev/shm)")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--set", action="append", default=[], metavar="LINE", help='config line added to the plugin config, e.g. "move_workers = 4"')
+    parser.add_argument("--save", metavar="FILE", help="write the results in FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare with the results saved in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work, temporary = work_directory(args.work)
+    library = os.path.join(work, "library")
+    db_path = os.path.join(work, "stash.sqlite")
+    server = None
+    try:
+        start = time.perf_counter()
+        make_library.generate(db_path, library, args.scenes, seed=args.seed)
+        print(f"{args.scenes} scenes generated in {time.perf_counter() - start:.1f}s ({work})")
+        plugin_dir = install_plugin(work, library, args.set)
+        server = mock_stash.serve(db_path, [library])
+        port = server.server_address[1]
+
+        hooks = random.Random(args.seed).sample(range(1, args.scenes + 1), min(args.hooks, args.scenes))
+        results = {
+            "bulk_dry": scenario("bulk_dry", plugin_dir, port, [{"mode": "bulk_full"}], args.scenes),
+        }
+        # the dry-run was switched on for this run only
+        with open(os.path.join(plugin_dir, "renamerOnUpdate_config.py"), "a", encoding="utf-8") as f:
+            f.write("dry_run = False\n")
+        results["hook"] = scenario("hook", plugin_dir, port, [{"hookContext": {"type": "Scene.Update.Post", "id": i}} for i in hooks], len(hooks))
+        results["bulk"] = scenario("bulk", plugin_dir, port, [{"mode": "bulk_full"}], args.scenes)
+        missing = check_library(db_path)
+
+        print(f"{'scenario':<10} {'scenes':>7} {'seconds':>8} {'scenes/s':>9} {'req/scene':>10} {'RSS MiB':>8} {'errors':>7}")
+        for name, r in results.items():
+            print(f"{name:<10} {r['scenes']:>7} {r['seconds']:>8} {r['scenes_per_sec']:>9} {r['requests_per_scene']:>10} {r['peak_rss_mib']:>8} {r['errors']:>7}")
+        if missing:
+            print(f"{missing} file(s) of the database are missing on the disk after the bulk rename")
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        failed = []
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                failed = compare(results, json.load(f), args.tolerance)
+            for line in failed:
+                print(f"REGRESSION {line}")
+        return 1 if failed or missing or any(r["errors"] for r in results.values()) else 0
+    finally:
+        if server is not None:
+            server.shutdown()
+        if temporary and not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""Benchmark the compiled template renderer against the previous implementation.
+
+The legacy functions below are the makeFilename/makePath/replace_text code the
+renderer replaced. Every synthetic scene is rendered with both and the outputs
+must be identical, then both are timed.
+
+replace_words changed on purpose: the previous replace_text applied every rule
+on the original name and kept the result of the last rule only, and its 'word'
+replacement broke on a value starting with a digit. The engine is checked
+against the sequential rule loop it implements, and the names that differ
+from the previous replace_text are counted for a few configs.
+
+    python bench_template.py [-n SCENES] [--rules RULES]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log  # noqa: E402
+from renamerOnUpdate_template import TemplateRenderer, WordReplacer  # noqa: E402
+
+FIELD_REPLACER = {"$studio": {"replace": "'", "with": ""}}
+PREVENT_TITLE_PERF = True
+FILENAME_SPLITCHAR = " "
+FILENAME_REPLACEWORDS = {}
+
+TEMPLATES = [
+    "$date $title",
+    "$title",
+    "$date $performer - $title [$studio]",
+    "$parent_studio $date $performer - $title",
+    "$year_$title-$height",
+    "[$studio] {$date -} $title",
+    "$studio_family - $title ($rating) [$video_codec $audio_codec] {$movie_title $movie_scene}",
+    "$performer $title $stashid_performer",
+    "{$studio_code }$title [$resolution] $duration",
+]
+PATH_PARTS = ["$studio", "$performer", "$year", "$studio_family", "{$parent_studio}", "$performer - $title", "Videos"]
+
+WORDS = ["Big", "Buck", "Bunny", "Sintel", "Tears", "Of", "Steel", "Dream", "Cosmos", "Spring", "(Part", "2)", "-", "Glass"]
+NAMES = ["Jane Doe", "John Smith", "Alex Lee", "Sam Martin", "Kim Garcia"]
+
+
+# ---- previous implementation --------------------------------------------
+
+def legacy_cleanup_text(text: str):
+    text = re.sub(r'\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}', '', text)
+    text = re.sub(r'[{}]', '', text)
+    text = legacy_remove_consecutive_nonword(text)
+    return text.strip(" -_.")
+
+
+def legacy_remove_consecutive_nonword(text: str):
+    for _ in range(0, 10):
+        m = re.findall(r'(\W+)\1+', text)
+        if m:
+            text = re.sub(r'(\W+)\1+', r'\1', text)
+        else:
+            break
+    return text
+
+
+def legacy_field_replacer(text: str, scene_information: dict):
+    field_found = re.findall(r"\$\w+", text)
+    result = text
+    title = None
+    replaced_word = ""
+    if field_found:
+        field_found.sort(key=len, reverse=True)
+    for i in range(0, len(field_found)):
+        f = field_found[i].replace("$", "").strip("_")
+        if f == "performer" and len(field_found) > i + 1 and scene_information.get('performer'):
+            if field_found[i+1] == "$title" and scene_information.get('title') and PREVENT_TITLE_PERF:
+                if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
+                    result = result.replace("$performer", "")
+                    continue
+        replaced_word = scene_information.get(f)
+        if not replaced_word:
+            replaced_word = ""
+        if FIELD_REPLACER.get(f"${f}"):
+            replaced_word = replaced_word.replace(FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"])
+        if f == "title":
+            title = replaced_word.strip()
+            continue
+        if replaced_word == "":
+            result = result.replace(field_found[i], replaced_word)
+        else:
+            result = result.replace(f"${f}", replaced_word)
+    return result, title
+
+
+def replace_text(text: str):
+    for old, new in FILENAME_REPLACEWORDS.items():
+        if type(new) is str:
+            new = [new]
+        if len(new) > 1:
+            if new[1] == "regex":
+                tmp = re.sub(old, new[0], text)
+                if tmp != text:
+                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
+            else:
+                if new[1] == "word":
+                    tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
+                elif new[1] == "any":
+                    tmp = text.replace(old, new[0])
+                if tmp != text:
+                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
+        else:
+            tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
+            if tmp != text:
+                log.LogDebug(f"'{old}' changed with '{new[0]}'")
+    return tmp
+
+
+def legacy_makeFilename(scene_information: dict, query: str) -> str:
+    new_filename = str(query)
+    r, t = legacy_field_replacer(new_filename, scene_information)
+    if not t:
+        r = r.replace("$title", "")
+    r = legacy_cleanup_text(r)
+    if t:
+        r = r.replace("$title", t)
+    r = r.replace(' ', FILENAME_SPLITCHAR)
+    return r
+
+
+def legacy_makePath(scene_information: dict, query: str) -> str:
+    new_filename = str(query)
+    new_filename = new_filename.replace("$performer", "$performer_path")
+    r, t = legacy_field_replacer(new_filename, scene_information)
+    if not t:
+        r = r.replace("$title", "")
+    r = legacy_cleanup_text(r)
+    if t:
+        r = r.replace("$title", t)
+    return r
+
+# -------------------------------------------------------------------------
+
+
+def sequential_replace_text(text: str, replace_words: dict):
+    # what WordReplacer does: the rules in the config order, each on the result of the previous one
+    for old, new in replace_words.items():
+        if type(new) is str:
+            new = [new]
+        system = new[1] if len(new) > 1 else "word"
+        if system == "regex":
+            text = re.sub(old, new[0], text)
+        elif system == "word":
+            text = re.sub(fr'([\s_-])({old})([\s_-])', f'\\g<1>{new[0]}\\g<3>', text)
+        elif system == "any":
+            text = text.replace(old, new[0])
+    return text
+
+
+def legacy_replace_text(text: str, replace_words: dict):
+    # the previous replace_text with these rules, an exception is part of its result
+    global FILENAME_REPLACEWORDS
+    FILENAME_REPLACEWORDS = replace_words
+    try:
+        return replace_text(text)
+    except re.error as err:
+        return f"re.error: {err}"
+
+
+def random_scene(rnd: random.Random) -> dict:
+    info = {}
+    performers = rnd.sample(NAMES, rnd.randint(0, 3))
+    title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 6)))
+    if performers and rnd.random() < 0.3:
+        title = f"{performers[0]} {title}"
+    optional = {
+        "title": title,
+        "performer": " ".join(performers),
+        "performer_path": performers[0] if performers else "",
+        "stashid_performer": " ".join(f"id-{rnd.randint(1, 99)}" for _ in performers),
+        "date": f"20{rnd.randint(10, 23)}-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}",
+        "studio": rnd.choice(["Blender Institute", "Pixar", "Dad's Studio", ""]),
+        "parent_studio": rnd.choice(["Blender", "Disney", ""]),
+        "rating": str(rnd.randint(1, 5)),
+        "movie_title": rnd.choice(["Movie", ""]),
+        "movie_scene": f"scene {rnd.randint(1, 9)}",
+        "studio_code": rnd.choice(["ABC-123", ""]),
+    }
+    for key, value in optional.items():
+        if rnd.random() < 0.8:
+            info[key] = value
+    if info.get("date"):
+        info["year"] = info["date"][0:4]
+    info["studio_family"] = info.get("parent_studio") or info.get("studio")
+    info.update({
+        "height": rnd.choice(["720p", "1080p", "4k"]),
+        "resolution": rnd.choice(["SD", "HD", "UHD"]),
+        "duration": str(rnd.randint(60, 7200)),
+        "video_codec": "H264",
+        "audio_codec": "AAC",
+    })
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--scenes", type=int, default=20000)
+    parser.add_argument("--rules", type=int, default=300, help="number of replace_words rules")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    scenes = [random_scene(rnd) for _ in range(args.scenes)]
+    jobs = [(scene, rnd.choice(TEMPLATES), rnd.choice(PATH_PARTS)) for scene in scenes]
+
+    # the debug lines (performer, replace_words) go to stderr, keep the output readable
+    log.LogDebug = lambda s: None
+
+    renderer = TemplateRenderer(field_replacer=FIELD_REPLACER, prevent_title_performer=PREVENT_TITLE_PERF, splitchar=FILENAME_SPLITCHAR)
+
+    mismatch = 0
+    for scene, template, part in jobs:
+        if renderer.filename(scene, template) != legacy_makeFilename(scene, template):
+            mismatch += 1
+            print(f"[filename] {template!r} {scene}")
+        if renderer.path(scene, part) != legacy_makePath(scene, part):
+            mismatch += 1
+            print(f"[path] {part!r} {scene}")
+    print(f"{len(jobs)} scenes rendered, {mismatch} mismatch(es)")
+
+    start = time.perf_counter()
+    for scene, template, part in jobs:
+        legacy_makeFilename(scene, template)
+        legacy_makePath(scene, part)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for scene, template, part in jobs:
+        renderer.filename(scene, template)
+        renderer.path(scene, part)
+    compiled = time.perf_counter() - start
+
+    print(f"legacy:   {legacy / len(jobs) * 1e6:.1f} us/scene")
+    print(f"compiled: {compiled / len(jobs) * 1e6:.1f} us/scene ({legacy / compiled:.1f}x)")
+
+    # replace_words
+    replace_words = {"Bunny": ["Rabbit", "word"], r"\bOf\b": ["of", "regex"], "ee": ["EE", "any"]}
+    for i in range(args.rules):
+        replace_words[f"word{i}"] = [f"w{i}", rnd.choice(["word", "any"])]
+    replacer = WordReplacer(replace_words)
+    names = [legacy_makeFilename(scene, template) for scene, template, _ in jobs]
+    rule_mismatch = sum(1 for name in names if replacer.replace(name) != sequential_replace_text(name, replace_words))
+    print(f"{len(names)} names with {len(replace_words)} replace_words rules, {rule_mismatch} mismatch(es) with the sequential rules")
+
+    # behaviour change against the previous replace_text
+    configs = {
+        "one 'word' rule": {"Bunny": ["Rabbit", "word"]},
+        "one 'any' rule": {"ee": ["EE", "any"]},
+        "one 'regex' rule": {r"\bOf\b": ["of", "regex"]},
+        "'word' rule, value starting with a digit": {"Bunny": ["2 Rabbits", "word"]},
+        "2 rules, both match": {"Bunny": ["Rabbit", "word"], "Steel": ["Iron", "word"]},
+        f"{len(replace_words)} rules (timed below)": replace_words,
+    }
+    print("names changed compared with the previous replace_text:")
+    for label, rules in configs.items():
+        config_replacer = WordReplacer(rules)
+        changed = errors = 0
+        for name in names:
+            legacy = legacy_replace_text(name, rules)
+            if config_replacer.replace(name) != legacy:
+                changed += 1
+                errors += legacy.startswith("re.error")
+        detail = f" ({errors} re.error in the previous one)" if errors else ""
+        print(f"  {label}: {changed}/{len(names)}{detail}")
+
+    start = time.perf_counter()
+    for name in names:
+        legacy_replace_text(name, replace_words)
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        replacer.replace(name)
+    compiled = time.perf_counter() - start
+    print(f"legacy:   {legacy / len(names) * 1e6:.1f} us/name")
+    print(f"compiled: {compiled / len(names) * 1e6:.1f} us/name ({legacy / compiled:.1f}x)")
+    return 1 if mismatch or rule_mismatch else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
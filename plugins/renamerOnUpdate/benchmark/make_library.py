@@ -0,0 +1,159 @@
+"""Generate a synthetic Stash library for the renamerOnUpdate benchmark.
+
+Creates a SQLite database using the post-refactor files/folders/scenes_files
+schema (only the tables and columns used by the plugin and mock_stash.py) with
+synthetic scenes, studios, performers and tags, and (optionally) the matching
+empty video files on disk. Every 10th scene has a .en.srt subtitle.
+
+    python make_library.py stash.sqlite library/ [-n SCENES] [--no-files]
+"""
+import argparse
+import os
+import random
+import sqlite3
+
+SCHEMA_VERSION = 45
+
+SCHEMA = """
+CREATE TABLE schema_migrations (version uint64, dirty bool);
+CREATE TABLE folders (
+    id INTEGER PRIMARY KEY, path varchar(255) NOT NULL, parent_folder_id integer,
+    zip_file_id integer, mod_time datetime, created_at datetime, updated_at datetime
+);
+CREATE UNIQUE INDEX index_folders_on_path_unique ON folders (path);
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY, basename varchar(255) NOT NULL, zip_file_id integer,
+    parent_folder_id integer NOT NULL, size integer, mod_time datetime,
+    created_at datetime, updated_at datetime
+);
+CREATE UNIQUE INDEX index_files_zip_basename_unique ON files (zip_file_id, parent_folder_id, basename);
+CREATE INDEX index_files_on_parent_folder_id_basename ON files (parent_folder_id, basename);
+CREATE TABLE files_fingerprints (file_id integer NOT NULL, type varchar(255) NOT NULL, fingerprint blob NOT NULL);
+CREATE TABLE video_files (
+    file_id integer NOT NULL, duration float, video_codec varchar(255), format varchar(255),
+    audio_codec varchar(255), width tinyint, height tinyint, frame_rate float, bit_rate integer,
+    interactive boolean, interactive_speed int
+);
+CREATE TABLE studios (id INTEGER PRIMARY KEY, name varchar(255), parent_id integer, created_at datetime, updated_at datetime);
+CREATE TABLE scenes (
+    id INTEGER PRIMARY KEY, title varchar(255), code text, details text, url varchar(255), date date,
+    rating tinyint, organized boolean, studio_id integer, created_at datetime, updated_at datetime
+);
+CREATE TABLE scenes_files (scene_id integer, file_id integer, "primary" boolean, PRIMARY KEY(scene_id, file_id));
+CREATE TABLE scene_stash_ids (scene_id integer, endpoint varchar(255), stash_id varchar(36));
+CREATE TABLE performers (id INTEGER PRIMARY KEY, name varchar(255), gender varchar(20), favorite boolean, rating tinyint);
+CREATE TABLE performers_scenes (performer_id integer, scene_id integer, PRIMARY KEY(scene_id, performer_id));
+CREATE TABLE performer_stash_ids (performer_id integer, endpoint varchar(255), stash_id varchar(36));
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name varchar(255));
+CREATE TABLE tags_relations (parent_id integer, child_id integer, PRIMARY KEY(parent_id, child_id));
+CREATE TABLE scenes_tags (scene_id integer, tag_id integer, PRIMARY KEY(scene_id, tag_id));
+CREATE TABLE movies (id INTEGER PRIMARY KEY, name varchar(255), date date);
+CREATE TABLE movies_scenes (movie_id integer, scene_id integer, scene_index tinyint);
+"""
+
+WORDS = [
+    "Big", "Buck", "Bunny", "Sintel", "Tears", "Of", "Steel", "Elephants", "Dream", "Cosmos",
+    "Laundromat", "Spring", "Agent", "Caminandes", "Glass", "Half", "Charge", "Sprite", "Fright",
+]
+FIRST = ["Jane", "John", "Alex", "Sam", "Kim", "Robin", "Jordan", "Casey", "Morgan", "Taylor"]
+LAST = ["Doe", "Smith", "Lee", "Martin", "Garcia", "Brown", "Lopez", "Moore", "Clark", "Hall"]
+GENDERS = ["FEMALE", "MALE", "FEMALE", "TRANSGENDER_FEMALE", None]
+HEIGHTS = [(640, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+
+
+def oshash_of_empty_file():
+    # oshash(size=0) = size + 0 checksum
+    return "0000000000000000"
+
+
+def generate(db_path, library_dir, scenes, studios=None, performers=None, tags=None, seed=1, create_files=True):
+    rnd = random.Random(seed)
+    studios = studios or max(scenes // 20, 4)
+    performers = performers or max(scenes // 5, 10)
+    tags = tags or 50
+    # the ratings are stored on a 100 scale since the schema 40
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    now = "2023-01-01T00:00:00+00:00"
+    db.execute("INSERT INTO schema_migrations VALUES (?, 0)", [SCHEMA_VERSION])
+
+    # studios: networks -> sites -> sub-sites
+    studio_rows = []
+    for i in range(1, studios + 1):
+        parent = None
+        if i > 3:
+            parent = rnd.randint(1, i - 1) if rnd.random() < 0.8 else None
+        studio_rows.append((i, f"Studio {rnd.choice(WORDS)} {i}", parent, now, now))
+    db.executemany("INSERT INTO studios VALUES (?,?,?,?,?)", studio_rows)
+
+    perf_rows = []
+    for i in range(1, performers + 1):
+        perf_rows.append((i, f"{rnd.choice(FIRST)} {rnd.choice(LAST)} {i}", rnd.choice(GENDERS), rnd.random() < 0.2, rnd.randint(0, 5) * 20 or None))
+    db.executemany("INSERT INTO performers VALUES (?,?,?,?,?)", perf_rows)
+    db.executemany("INSERT INTO performer_stash_ids VALUES (?,?,?)", [
+        (i, "https://stashdb.org/graphql", f"perf-{i:08d}") for i in range(1, performers + 1) if i % 2
+    ])
+    db.executemany("INSERT INTO tags VALUES (?,?)", [(i, f"Tag {i}") for i in range(1, tags + 1)])
+    db.executemany("INSERT INTO tags_relations VALUES (?,?)", [(i // 2, i) for i in range(2, tags + 1, 3)])
+    db.executemany("INSERT INTO movies VALUES (?,?,?)", [(i, f"Movie {i}", f"20{10 + i % 10}-01-01") for i in range(1, scenes // 50 + 2)])
+
+    folder_ids = {}
+
+    def folder(path):
+        if path in folder_ids:
+            return folder_ids[path]
+        parent = os.path.dirname(path)
+        parent_id = folder(parent) if parent != path and path != library_dir else None
+        folder_id = len(folder_ids) + 1
+        db.execute("INSERT INTO folders VALUES (?,?,?,?,?,?,?)", [folder_id, path, parent_id, None, now, now, now])
+        folder_ids[path] = folder_id
+        if create_files:
+            os.makedirs(path, exist_ok=True)
+        return folder_id
+
+    folder(library_dir)
+    for i in range(1, scenes + 1):
+        directory = os.path.join(library_dir, f"import{i % 7}", f"batch{i % 31}")
+        basename = f"scene_{i:07d}_{rnd.choice(WORDS).lower()}.mp4"
+        folder_id = folder(directory)
+        created = f"2023-01-01T00:{(i // 60) % 60:02d}:{i % 60:02d}+00:00"
+        db.execute("INSERT INTO files VALUES (?,?,?,?,?,?,?,?)", [i, basename, None, folder_id, 0, now, now, now])
+        width, height = rnd.choice(HEIGHTS)
+        db.execute("INSERT INTO video_files VALUES (?,?,?,?,?,?,?,?,?,?,?)", [
+            i, rnd.randint(60, 7200), "h264", "mp4", "aac", width, height, 29.97, rnd.randint(1000000, 20000000), 0, None
+        ])
+        db.execute("INSERT INTO files_fingerprints VALUES (?,?,?)", [i, "oshash", oshash_of_empty_file()])
+        db.execute("INSERT INTO files_fingerprints VALUES (?,?,?)", [i, "md5", f"{i:032x}"])
+        title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 5)))
+        date = f"20{rnd.randint(10, 23)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}" if rnd.random() < 0.9 else None
+        db.execute("INSERT INTO scenes VALUES (?,?,?,?,?,?,?,?,?,?,?)", [
+            i, title, f"CODE-{i}" if i % 3 else None, None, None, date, rnd.randint(1, 5) * 20 if rnd.random() < 0.5 else None,
+            rnd.random() < 0.7, rnd.randint(1, studios) if rnd.random() < 0.9 else None, created, created
+        ])
+        db.execute("INSERT INTO scenes_files VALUES (?,?,1)", [i, i])
+        if i % 4 == 0:
+            db.execute("INSERT INTO scene_stash_ids VALUES (?,?,?)", [i, "https://stashdb.org/graphql", f"scene-{i:08d}"])
+        for p in rnd.sample(range(1, performers + 1), rnd.randint(0, 4)):
+            db.execute("INSERT INTO performers_scenes VALUES (?,?)", [p, i])
+        for t in rnd.sample(range(1, tags + 1), rnd.randint(0, 6)):
+            db.execute("INSERT INTO scenes_tags VALUES (?,?)", [i, t])
+        if i % 50 == 0:
+            db.execute("INSERT INTO movies_scenes VALUES (?,?,?)", [i // 50, i, rnd.randint(1, 9)])
+        if create_files:
+            open(os.path.join(directory, basename), "w").close()
+            if i % 10 == 0:
+                open(os.path.join(directory, os.path.splitext(basename)[0] + ".en.srt"), "w").close()
+    db.commit()
+    db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("database")
+    parser.add_argument("library")
+    parser.add_argument("-n", "--scenes", type=int, default=1000)
+    parser.add_argument("--no-files", action="store_true", help="only generate the database")
+    args = parser.parse_args()
+    generate(args.database, os.path.abspath(args.library), args.scenes, create_files=not args.no_files)
@@ -0,0 +1,237 @@
+"""Local stand-in for the Stash GraphQL API, backed by a Stash SQLite file.
+
+Only the queries and mutations used by renamerOnUpdate are understood. The
+query text is not parsed: the root field decides what is answered. Like
+Stash, the related objects (performers, tags, movies, studio, stash ids) are
+only resolved when the query asks for them, the other fields are always
+returned.
+
+GET /stats returns the number of requests per root field.
+
+    python mock_stash.py stash.sqlite --stash /path/to/library [--port 9999]
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SORT_COLUMNS = {"id": "scenes.id", "created_at": "scenes.created_at", "updated_at": "scenes.updated_at", "title": "scenes.title"}
+
+
+def rating5(rating100):
+    # the deprecated 'rating' field of Stash: rating100 / 20, rounded half away from zero
+    return None if rating100 is None else int(rating100 / 20 + 0.5)
+
+
+class StashData:
+    def __init__(self, db_path, stashes):
+        self.db_path = db_path
+        self.stashes = stashes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    @property
+    def db(self):
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.db_path, timeout=30)
+            self.local.db.row_factory = sqlite3.Row
+        return self.local.db
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def schema_version(self):
+        return self.db.execute("SELECT version FROM schema_migrations").fetchone()[0]
+
+    def studio(self, studio_id):
+        row = self.db.execute("SELECT id, name, parent_id FROM studios WHERE id=?", [studio_id]).fetchone()
+        if row is None:
+            return None
+        parent = None
+        if row["parent_id"]:
+            p = self.db.execute("SELECT id, name FROM studios WHERE id=?", [row["parent_id"]]).fetchone()
+            parent = {"id": str(p["id"]), "name": p["name"]}
+        return {"id": str(row["id"]), "name": row["name"], "parent_studio": parent}
+
+    def scene(self, row):
+        db = self.db
+        scene_id = row["id"]
+        files = []
+        for f in db.execute(
+            """SELECT files.id, folders.path, files.basename, video_files.* FROM scenes_files
+               JOIN files ON files.id = scenes_files.file_id
+               JOIN folders ON folders.id = files.parent_folder_id
+               JOIN video_files ON video_files.file_id = files.id
+               WHERE scenes_files.scene_id = ? ORDER BY scenes_files."primary" DESC, files.id""", [scene_id]):
+            fingerprints = [
+                {"type": fp["type"], "value": fp["fingerprint"]}
+                for fp in db.execute("SELECT type, fingerprint FROM files_fingerprints WHERE file_id=?", [f["id"]])
+            ]
+            files.append({
+                "path": os.path.join(f["path"], f["basename"]),
+                "video_codec": f["video_codec"], "audio_codec": f["audio_codec"],
+                "width": f["width"], "height": f["height"], "frame_rate": f["frame_rate"],
+                "duration": f["duration"], "bit_rate": f["bit_rate"], "fingerprints": fingerprints,
+            })
+        fingerprint = {fp["type"]: fp["value"] for fp in (files[0]["fingerprints"] if files else [])}
+        performers = []
+        for p in db.execute(
+            """SELECT performers.* FROM performers_scenes JOIN performers ON performers.id = performers_scenes.performer_id
+               WHERE performers_scenes.scene_id = ? ORDER BY performers.id""", [scene_id]):
+            performers.append({
+                "id": str(p["id"]), "name": p["name"], "gender": p["gender"],
+                "favorite": bool(p["favorite"]), "rating": rating5(p["rating"]),
+                "stash_ids": [{"endpoint": s[0], "stash_id": s[1]} for s in db.execute(
+                    "SELECT endpoint, stash_id FROM performer_stash_ids WHERE performer_id=?", [p["id"]])],
+            })
+        return {
+            "id": str(scene_id),
+            "oshash": fingerprint.get("oshash"),
+            "checksum": fingerprint.get("md5"),
+            "title": row["title"],
+            "code": row["code"],
+            "date": row["date"],
+            "rating": rating5(row["rating"]),
+            "organized": bool(row["organized"]),
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "stash_ids": [{"endpoint": s[0], "stash_id": s[1]} for s in db.execute(
+                "SELECT endpoint, stash_id FROM scene_stash_ids WHERE scene_id=?", [scene_id])],
+            "files": files,
+            "studio": self.studio(row["studio_id"]) if row["studio_id"] else None,
+            "tags": [{"id": str(t[0]), "name": t[1]} for t in db.execute(
+                "SELECT tags.id, tags.name FROM scenes_tags JOIN tags ON tags.id = scenes_tags.tag_id WHERE scene_id=? ORDER BY tags.id", [scene_id])],
+            "performers": performers,
+            "movies": [{"movie": {"name": m[0], "date": m[1]}, "scene_index": m[2]} for m in db.execute(
+                "SELECT movies.name, movies.date, movies_scenes.scene_index FROM movies_scenes JOIN movies ON movies.id = movies_scenes.movie_id WHERE scene_id=?", [scene_id])],
+        }
+
+    def find_scenes(self, variables):
+        find_filter = variables.get("filter") or {}
+        scene_filter = variables.get("scene_filter") or {}
+        where, params = [], []
+        if scene_filter.get("path"):
+            value = scene_filter["path"]["value"]
+            where.append("""scenes.id IN (SELECT scenes_files.scene_id FROM scenes_files JOIN files ON files.id = scenes_files.file_id
+                            JOIN folders ON folders.id = files.parent_folder_id
+                            WHERE folders.path || ? || files.basename = ? OR files.basename = ?)""")
+            params += [os.sep, value, value]
+        if variables.get("scene_ids"):
+            where.append(f"scenes.id IN ({','.join('?' * len(variables['scene_ids']))})")
+            params += [int(i) for i in variables["scene_ids"]]
+        if scene_filter.get("updated_at"):
+            where.append("scenes.updated_at > ?")
+            params.append(scene_filter["updated_at"]["value"])
+        sql_where = f"WHERE {' AND '.join(where)}" if where else ""
+        count = self.db.execute(f"SELECT COUNT(*) FROM scenes {sql_where}", params).fetchone()[0]
+        sort = SORT_COLUMNS.get(find_filter.get("sort", "id"), "scenes.id")
+        direction = "DESC" if find_filter.get("direction") == "DESC" else "ASC"
+        per_page = find_filter.get("per_page", 25)
+        page = find_filter.get("page", 1)
+        limit = ""
+        if per_page >= 0:
+            limit = f"LIMIT {int(per_page)} OFFSET {int((page - 1) * per_page)}"
+        rows = self.db.execute(f"SELECT * FROM scenes {sql_where} ORDER BY {sort} {direction}, scenes.id {direction} {limit}", params)
+        return {"count": count, "scenes": [self.scene(row) for row in rows.fetchall()]}
+
+    def answer(self, query, variables):
+        if "systemStatus" in query:
+            self.count("systemStatus")
+            return {"systemStatus": {"databaseSchema": self.schema_version()}}
+        if "configuration" in query:
+            self.count("configuration")
+            return {"configuration": {"general": {"databasePath": self.db_path, "stashes": [{"path": p} for p in self.stashes]}}}
+        if "bulkSceneUpdate" in query:
+            self.count("bulkSceneUpdate")
+            data = variables["input"]
+            for scene_id in data["ids"]:
+                for tag_id in data["tag_ids"]["ids"]:
+                    self.db.execute("DELETE FROM scenes_tags WHERE scene_id=? AND tag_id=?", [scene_id, tag_id])
+            self.db.commit()
+            return {"bulkSceneUpdate": [{"id": i} for i in data["ids"]]}
+        if "findStudios" in query:
+            self.count("findStudios")
+            find_filter = variables.get("filter") or {}
+            per_page, page = find_filter.get("per_page", 25), find_filter.get("page", 1)
+            count = self.db.execute("SELECT COUNT(*) FROM studios").fetchone()[0]
+            rows = self.db.execute("SELECT id, name, parent_id FROM studios ORDER BY id LIMIT ? OFFSET ?", [per_page, (page - 1) * per_page])
+            return {"findStudios": {"count": count, "studios": [
+                {"id": str(r[0]), "name": r[1], "parent_studio": {"id": str(r[2])} if r[2] else None} for r in rows]}}
+        if "findStudio" in query:
+            self.count("findStudio")
+            return {"findStudio": self.studio(variables["id"])}
+        if "findScenes" in query:
+            self.count("findScenes")
+            result = self.find_scenes(variables)
+            result["scenes"] = [project(scene, query) for scene in result["scenes"]]
+            return {"findScenes": result}
+        if "findScene" in query:
+            self.count("findScene")
+            row = self.db.execute("SELECT * FROM scenes WHERE id=?", [variables["id"]]).fetchone()
+            return {"findScene": project(self.scene(row), query) if row else None}
+        raise ValueError(f"unsupported query: {query[:80]}")
+
+
+def project(scene, query):
+    # drop the related objects that the query doesn't ask for
+    for key in ("performers", "tags", "movies", "studio", "stash_ids"):
+        if not re.search(rf"\b{key}\b", query):
+            scene.pop(key, None)
+    return scene
+
+
+class Handler(BaseHTTPRequestHandler):
+    data = None
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length))
+        try:
+            body = {"data": self.data.answer(payload["query"], payload.get("variables") or {})}
+        except Exception as err:
+            body = {"errors": [{"message": str(err)}]}
+        raw = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        # /stats returns the request counters
+        raw = json.dumps(self.data.requests).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(db_path, stashes, port=0, background=True):
+    handler = type("BoundHandler", (Handler,), {"data": StashData(db_path, stashes)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("database")
+    parser.add_argument("--stash", action="append", default=[], help="library root reported in the configuration")
+    parser.add_argument("--port", type=int, default=9999)
+    args = parser.parse_args()
+    server = serve(os.path.abspath(args.database), args.stash, args.port, background=False)
+    print(f"Mock Stash listening on http://127.0.0.1:{server.server_address[1]}/graphql")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,27 +1,33 @@
-import difflib
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import heapq
+import importlib.util
 import json
+import math
 import os
+import queue
 import re
+import secrets
 import shutil
+import socket
 import sqlite3
+import struct
+import subprocess
 import sys
+import threading
 import time
 import traceback
+import urllib.request
 from datetime import datetime
 
-import requests
-
-try:
-    import psutil  # pip install psutil
-    MODULE_PSUTIL = True
-except Exception:
-    MODULE_PSUTIL = False
-
-try:
-    import unidecode  # pip install Unidecode
-    MODULE_UNIDECODE = True
-except Exception:
-    MODULE_UNIDECODE = False
+# The hook starts a new process for every scene update, the modules that are not always
+# needed (requests, difflib, psutil, unidecode) are imported where they are used.
+# pip install psutil
+MODULE_PSUTIL = importlib.util.find_spec("psutil") is not None
+# pip install Unidecode
+MODULE_UNIDECODE = importlib.util.find_spec("unidecode") is not None
 
 
 try:
@@ -29,10 +35,12 @@ try:
 except Exception:
     import config
 import log
+from renamerOnUpdate_template import TemplateRenderer
 
 
 DB_VERSION_FILE_REFACTOR = 32
 DB_VERSION_SCENE_STUDIO_CODE = 38
+DB_VERSION_RATING100 = 40
 
 DRY_RUN = config.dry_run
 DRY_RUN_FILE = None
@@ -47,6 +55,8 @@ if DRY_RUN:
     log.LogInfo("Dry mode on")
 
 START_TIME = time.time()
+# every run that renames something starts its lines in the log file with '#RUN|id|date|mode' (revert task)
+RUN_ID = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
 FRAGMENT = json.loads(sys.stdin.read())
 
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
@@ -55,9 +65,124 @@ PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
 
 PLUGIN_ARGS = FRAGMENT['args'].get("mode")
 
+# studio id -> studio (id, name, parent_studio id), filled per run
+STUDIO_CACHE = {}
+# bulk: scenes whose move or database update failed, the incremental watermark stays before them
+BULK_FAILED = set()
+# the bulk moves run in threads
+LOGFILE_LOCK = threading.Lock()
+LOGFILE_RUN_WRITTEN = False
+# one requests session per thread, the connection is kept between the queries
+GRAPHQL_SESSION = threading.local()
+# cross-device copy
+COPY_CHUNK_SIZE = 32 * 1024 * 1024
+OSHASH_CHUNK_SIZE = 64 * 1024
+
 #log.LogDebug("{}".format(FRAGMENT))
 
 
+class RunStats:
+    # Time spent in each phase (graphql, template, move, database...) and counters of the run.
+    # stats_summary writes the summary at exit, stats_trace the phases of each scene.
+    # The moves run in threads, the scene of a thread is set with scene().
+    def __init__(self, enabled=False, trace_path=None):
+        self.enabled = enabled or trace_path is not None
+        self.trace_path = trace_path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.samples = {}
+        self.counters = {}
+        self.traces = {}
+
+    def scene(self, scene_id):
+        self.local.scene_id = scene_id
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timer(name)
+
+    @contextlib.contextmanager
+    def _timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        scene_id = getattr(self.local, "scene_id", None)
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if self.trace_path and scene_id is not None:
+                trace = self.traces.setdefault(scene_id, {})
+                trace[f"{name}_ms"] = trace.get(f"{name}_ms", 0) + seconds * 1000
+
+    def count(self, name: str, n=1):
+        if not self.enabled:
+            return
+        scene_id = getattr(self.local, "scene_id", None)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if self.trace_path and scene_id is not None:
+                trace = self.traces.setdefault(scene_id, {})
+                trace[name] = trace.get(name, 0) + n
+
+    @staticmethod
+    def percentile(values: list, p: int):
+        # nearest rank, values are sorted
+        return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+    def summary(self):
+        phases = {}
+        with self.lock:
+            for name, values in self.samples.items():
+                values = sorted(values)
+                phases[name] = {
+                    "count": len(values),
+                    "total_s": round(sum(values), 4),
+                    "p50_ms": round(self.percentile(values, 50) * 1000, 3),
+                    "p95_ms": round(self.percentile(values, 95) * 1000, 3),
+                    "max_ms": round(values[-1] * 1000, 3),
+                }
+            counters = dict(sorted(self.counters.items()))
+        return {
+            "mode": PLUGIN_ARGS or "hook",
+            "date": datetime.now().astimezone().isoformat('T', 'seconds'),
+            "elapsed_s": round(time.time() - START_TIME, 4),
+            "counters": counters,
+            "phases": dict(sorted(phases.items(), key=lambda item: -item[1]["total_s"])),
+        }
+
+    def write(self):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        log.LogInfo(f"[Stats] {json.dumps(summary)}")
+        try:
+            with open(STATS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+            if self.trace_path and self.traces:
+                with open(self.trace_path, 'w', encoding='utf-8') as f:
+                    for scene_id, trace in self.traces.items():
+                        trace = {k: round(v, 3) if type(v) is float else v for k, v in trace.items()}
+                        f.write(json.dumps({"scene_id": scene_id, **trace}) + "\n")
+        except OSError as err:
+            log.LogWarning(f"Failed to write the stats ({err})")
+
+
+STATS_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_stats.json")
+STATS = RunStats(config.stats_summary, os.path.join(PLUGIN_DIR, "renamerOnUpdate_trace.jsonl") if config.stats_trace else None)
+# cProfile of the whole run, the stats of the last run are in renamerOnUpdate.prof
+PROFILER = None
+if config.profile:
+    import cProfile
+    PROFILER = cProfile.Profile()
+    PROFILER.enable()
+
+
 def callGraphQL(query, variables=None):
     # Session cookie for authentication
     graphql_port = str(FRAGMENT_SERVER['Port'])
@@ -79,22 +204,28 @@ def callGraphQL(query, variables=None):
     json = {'query': query}
     if variables is not None:
         json['variables'] = variables
-    try:
-        response = requests.post(graphql_url, json=json, headers=graphql_headers, cookies=graphql_cookies, timeout=20)
-    except Exception as e:
-        exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
-    if response.status_code == 200:
-        result = response.json()
-        if result.get("error"):
-            for error in result["error"]["errors"]:
-                raise Exception(f"GraphQL error: {error}")
-            return None
-        if result.get("data"):
-            return result.get("data")
-    elif response.status_code == 401:
-        exit_plugin(err="HTTP Error 401, Unauthorised.")
-    else:
-        raise ConnectionError(f"GraphQL query failed: {response.status_code} - {response.content}")
+    session = getattr(GRAPHQL_SESSION, "session", None)
+    if session is None:
+        import requests
+        session = GRAPHQL_SESSION.session = requests.Session()
+    with STATS.phase("graphql"):
+        try:
+            response = session.post(graphql_url, json=json, headers=graphql_headers, cookies=graphql_cookies, timeout=20)
+        except Exception as e:
+            exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
+        # reading the answer is part of the request time
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("error"):
+                for error in result["error"]["errors"]:
+                    raise Exception(f"GraphQL error: {error}")
+                return None
+            if result.get("data"):
+                return result.get("data")
+        elif response.status_code == 401:
+            exit_plugin(err="HTTP Error 401, Unauthorised.")
+        else:
+            raise ConnectionError(f"GraphQL query failed: {response.status_code} - {response.content}")
 
 
 def graphql_getScene(scene_id):
@@ -104,48 +235,7 @@ def graphql_getScene(scene_id):
             ...SceneData
         }
     }
-    fragment SceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        stash_ids {
-            endpoint
-            stash_id
-        }
-        organized""" + FILE_QUERY + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
+    fragment SceneData on Scene {""" + SCENE_FIELDS + """
     }
     """
     variables = {
@@ -156,67 +246,45 @@ def graphql_getScene(scene_id):
 
 
 # used for bulk
-def graphql_findScene(perPage, direc="DESC") -> dict:
+def graphql_findScene(perPage, direc="DESC", page=1, sort="updated_at", scene_filter=None, scene_ids=None) -> dict:
     query = """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType, $scene_ids: [Int!]) {
+        findScenes(filter: $filter, scene_filter: $scene_filter, scene_ids: $scene_ids) {
             count
             scenes {
                 ...SlimSceneData
             }
         }
     }
-    fragment SlimSceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        organized
-        stash_ids {
-            endpoint
-            stash_id
-        }
-    """ + FILE_QUERY + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
+    fragment SlimSceneData on Scene {""" + SCENE_FIELDS + """
     }
     """
     # ASC DESC
-    variables = {'filter': {"direction": direc, "page": 1, "per_page": perPage, "sort": "updated_at"}}
+    variables = {'filter': {"direction": direc, "page": page, "per_page": perPage, "sort": sort}}
+    if scene_filter:
+        variables['scene_filter'] = scene_filter
+    if scene_ids:
+        variables['scene_ids'] = scene_ids
     result = callGraphQL(query, variables)
     return result.get("findScenes")
 
 
+# used for bulk, yield (page, count, scenes) for every page
+def graphql_iterScenes(perPage, page=1, scene_filter=None):
+    # created_at doesn't change when a scene is renamed, so the pages stay stable during the run
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(graphql_findScene, perPage, "ASC", page, "created_at", scene_filter)
+        while future:
+            result = future.result()
+            future = None
+            # prefetch the next page while the current one is renamed
+            if result["scenes"] and page * perPage < result["count"]:
+                future = executor.submit(graphql_findScene, perPage, "ASC", page + 1, "created_at", scene_filter)
+            if result["scenes"]:
+                yield page, result["count"], result["scenes"]
+            page += 1
+
+
 # used to find duplicate
 def graphql_findScenebyPath(path, modifier) -> dict:
     query = """
@@ -256,6 +324,9 @@ def graphql_getConfiguration():
             configuration {
                 general {
                     databasePath
+                    stashes {
+                        path
+                    }
                 }
             }
         }
@@ -264,6 +335,44 @@ def graphql_getConfiguration():
     return result.get('configuration')
 
 
+def get_stash_info():
+    # databasePath, stashes and databaseSchema. The hook runs for every scene update, it uses a copy
+    # saved by the last run for startup_cache_ttl seconds. The tasks always ask Stash.
+    server = f"{FRAGMENT_SERVER['Host']}:{FRAGMENT_SERVER['Port']}"
+    if not PLUGIN_ARGS and STARTUP_CACHE_TTL > 0 and os.path.isfile(STARTUP_CACHE_FILE):
+        try:
+            with open(STARTUP_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache["server"] == server and 0 <= time.time() - cache["time"] < STARTUP_CACHE_TTL and os.path.isfile(cache["databasePath"]):
+                return cache
+        except (OSError, ValueError, KeyError) as err:
+            log.LogDebug(f"Ignoring the startup cache ({err})")
+    general = graphql_getConfiguration()['general']
+    info = {
+        "server": server,
+        "time": time.time(),
+        "databasePath": general['databasePath'],
+        "stashes": [stash['path'] for stash in general.get('stashes') or []],
+        "databaseSchema": graphql_getBuild()
+    }
+    if STARTUP_CACHE_TTL > 0:
+        try:
+            with open(STARTUP_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+        except OSError as err:
+            log.LogDebug(f"Failed to write the startup cache ({err})")
+    return info
+
+
+def clear_stash_info():
+    # the next run asks Stash again (database moved, Stash updated...)
+    try:
+        if os.path.isfile(STARTUP_CACHE_FILE):
+            os.remove(STARTUP_CACHE_FILE)
+    except OSError:
+        pass
+
+
 def graphql_getStudio(studio_id):
     query = """
         query FindStudio($id:ID!) {
@@ -284,6 +393,26 @@ def graphql_getStudio(studio_id):
     return result.get("findStudio")
 
 
+def graphql_findStudios(page, perPage) -> dict:
+    query = """
+        query FindStudios($filter: FindFilterType) {
+            findStudios(filter: $filter) {
+                count
+                studios {
+                    id
+                    name
+                    parent_studio {
+                        id
+                    }
+                }
+            }
+        }
+    """
+    variables = {'filter': {"direction": "ASC", "page": page, "per_page": perPage, "sort": "name"}}
+    result = callGraphQL(query, variables)
+    return result.get("findStudios")
+
+
 def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     query = """
     mutation BulkSceneUpdate($input: BulkSceneUpdateInput!) {
@@ -312,6 +441,7 @@ def graphql_getBuild():
 def find_diff_text(a: str, b: str):
     addi = minus = stay = ""
     minus_ = addi_ = 0
+    import difflib
     for _, s in enumerate(difflib.ndiff(a, b)):
         if s[0] == ' ':
             stay += s[-1]
@@ -332,19 +462,102 @@ def find_diff_text(a: str, b: str):
     return
 
 
+class HandleMap:
+    # path -> pids of the processes that have the file open. Built with one sweep of all the
+    # processes (/proc/*/fd on Linux, psutil elsewhere) the first time a file is locked,
+    # then shared by the run. A path not found in an old map rebuilds it once.
+    MAX_AGE = 2
+
+    def __init__(self):
+        self.handles = None
+        self.built = 0
+        self.lock = threading.Lock()
+
+    @property
+    def available(self):
+        return MODULE_PSUTIL or os.path.isdir("/proc/self/fd")
+
+    def refresh(self):
+        handles = {}
+        start = time.time()
+        if os.path.isdir("/proc/self/fd"):
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit():
+                    continue
+                fd_dir = f"/proc/{pid}/fd"
+                try:
+                    for fd in os.listdir(fd_dir):
+                        try:
+                            handles.setdefault(os.readlink(os.path.join(fd_dir, fd)), set()).add(int(pid))
+                        except OSError:
+                            pass
+                except OSError:
+                    # process ended or not allowed
+                    pass
+        elif MODULE_PSUTIL:
+            import psutil
+            for proc in psutil.process_iter():
+                try:
+                    for item in proc.open_files():
+                        handles.setdefault(os.path.normcase(item.path), set()).add(proc.pid)
+                except Exception:
+                    pass
+        self.handles = handles
+        self.built = time.time()
+        log.LogDebug(f"[Handles] {len(handles)} open files found in {self.built - start:.2f}s")
+
+    def lookup(self, path: str):
+        key = os.path.normcase(os.path.realpath(path))
+        with self.lock:
+            if self.handles is None or (key not in self.handles and time.time() - self.built > self.MAX_AGE):
+                self.refresh()
+            return sorted(self.handles.get(key, ()))
+
+    def forget(self, path: str):
+        with self.lock:
+            if self.handles is not None:
+                self.handles.pop(os.path.normcase(os.path.realpath(path)), None)
+
+
+def file_in_use(err: OSError) -> bool:
+    # Windows sharing violation, or a busy file on POSIX (network share, running executable)
+    return getattr(err, "winerror", None) == 32 or err.errno in (errno.EBUSY, errno.ETXTBSY)
+
+
 def has_handle(fpath, all_result=False):
-    lst = []
-    for proc in psutil.process_iter():
-        try:
-            for item in proc.open_files():
-                if fpath == item.path:
-                    if all_result:
-                        lst.append(proc)
-                    else:
-                        return proc
-        except Exception:
-            pass
-    return lst
+    # pids of the processes using the file, only the first one if not all_result
+    with STATS.phase("handle_lookup"):
+        pids = HANDLE_MAP.lookup(fpath)
+    if all_result:
+        return pids
+    return pids[:1]
+
+
+def load_studio_cache(perPage=1000):
+    # Load the whole studio tree once, so the hierarchy is resolved from memory
+    if SCENE_READER is not None:
+        STUDIO_CACHE.update(SCENE_READER.studios())
+        log.LogDebug(f"[Studio] {len(STUDIO_CACHE)} studios cached (database)")
+        return
+    page = 1
+    while True:
+        result = graphql_findStudios(page, perPage)
+        for studio in result["studios"]:
+            STUDIO_CACHE[studio["id"]] = studio
+        if page * perPage >= result["count"]:
+            break
+        page += 1
+    log.LogDebug(f"[Studio] {len(STUDIO_CACHE)} studios cached")
+
+
+def get_studio(studio_id):
+    studio = STUDIO_CACHE.get(studio_id)
+    if studio is None:
+        # not in the cache (hook or new studio), fetch it once
+        studio = graphql_getStudio(studio_id)
+        if studio:
+            STUDIO_CACHE[studio_id] = studio
+    return studio
 
 
 def config_edit(name: str, state: bool):
@@ -374,6 +587,89 @@ def check_longpath(path: str):
         return 1
 
 
+def configured_templates():
+    filename_templates = list(config.tag_templates.values()) + list(config.studio_templates.values()) + [config.default_template]
+    path_templates = list(config.p_tag_templates.values()) + list(config.p_studio_templates.values()) + list(config.p_path_templates.values()) + [config.p_default_template, PATH_NON_ORGANIZED]
+    return [t for t in filename_templates if t], [t for t in path_templates if t]
+
+
+def compile_templates():
+    # parse every configured template once, rendering a scene only does the replacements
+    filename_templates, path_templates = configured_templates()
+    for template in filename_templates:
+        TEMPLATE_RENDERER.compile_filename(template)
+    for template in path_templates:
+        for part in os.path.normpath(template).split(os.sep):
+            TEMPLATE_RENDERER.compile_path(part)
+
+
+def build_scene_fields():
+    # Scene fields asked to Stash: only what the templates ($fields) and the options use.
+    filename_templates, path_templates = configured_templates()
+    fields = set()
+    for template in filename_templates + path_templates:
+        fields.update(f.strip("_") for f in re.findall(r"\$(\w+)", str(template)))
+    query = """
+        id
+        oshash
+        checksum
+        title
+        date
+        rating
+        organized
+        updated_at"""
+    if "stashid_scene" in fields:
+        query += """
+        stash_ids {
+            endpoint
+            stash_id
+        }"""
+    query += FILE_QUERY
+    if config.studio_templates or config.p_studio_templates or fields & {"studio", "studio_family", "parent_studio", "studio_hierarchy"}:
+        query += """
+        studio {
+            id
+            name
+            parent_studio {
+                id
+                name
+            }
+        }"""
+    if config.tag_templates or config.p_tag_templates or config.p_tag_option or "tags" in fields:
+        query += """
+        tags {
+            id
+            name
+        }"""
+    if fields & {"performer", "stashid_performer"}:
+        query += """
+        performers {
+            id
+            name
+            gender
+            favorite
+            rating"""
+        if "stashid_performer" in fields:
+            query += """
+            stash_ids{
+                endpoint
+                stash_id
+            }"""
+        query += """
+        }"""
+    if any(f.startswith("movie_") for f in fields):
+        query += """
+        movies {
+            movie {
+                name
+                date
+            }
+            scene_index
+        }"""
+    log.LogDebug(f"[GraphQL] Scene fields for the templates: {sorted(fields)}")
+    return query
+
+
 def get_template_filename(scene: dict):
     template = None
     # Change by Studio
@@ -385,13 +681,15 @@ def get_template_filename(scene: dict):
             template_found = True
         # by first Parent found
         while current_studio.get("parent_studio") and not template_found:
-            if config.studio_templates.get(current_studio.get("parent_studio").get("name")):
-                template = config.studio_templates[current_studio['parent_studio']['name']]
+            current_studio = get_studio(current_studio["parent_studio"]["id"])
+            if not current_studio:
+                break
+            if config.studio_templates.get(current_studio["name"]):
+                template = config.studio_templates[current_studio["name"]]
                 template_found = True
-            current_studio = graphql_getStudio(current_studio.get("parent_studio")['id'])
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
+    tags = [x["name"] for x in scene.get("tags") or []]
     if scene.get("tags") and config.tag_templates:
         for match, job in config.tag_templates.items():
             if match in tags:
@@ -419,7 +717,7 @@ def get_template_path(scene: dict):
                 template["destination"] = config.p_studio_templates[scene["studio"]["name"]]
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
+    tags = [x["name"] for x in scene.get("tags") or []]
     if scene.get("tags") and config.p_tag_templates:
         for match, job in config.p_tag_templates.items():
             if match in tags:
@@ -607,12 +905,13 @@ def extract_info(scene: dict, template: None):
 
             studio_p = scene['studio']
             while studio_p.get("parent_studio"):
-                studio_p = graphql_getStudio(studio_p['parent_studio']['id'])
-                if studio_p:
-                    if SQUEEZE_STUDIO_NAMES:
-                        studio_hierarchy.append(studio_p['name'].replace(' ', ''))
-                    else:
-                        studio_hierarchy.append(studio_p['name'])
+                studio_p = get_studio(studio_p['parent_studio']['id'])
+                if not studio_p:
+                    break
+                if SQUEEZE_STUDIO_NAMES:
+                    studio_hierarchy.append(studio_p['name'].replace(' ', ''))
+                else:
+                    studio_hierarchy.append(studio_p['name'])
             studio_hierarchy.reverse()
         scene_information['studio_hierarchy'] = studio_hierarchy
     # Grab Tags
@@ -675,111 +974,13 @@ def extract_info(scene: dict, template: None):
     return scene_information
 
 
-def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
-        if type(new) is str:
-            new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
-            else:
-                if new[1] == "word":
-                    tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
-        else:
-            tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-            if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
-    return tmp
-
-
-def cleanup_text(text: str):
-    text = re.sub(r'\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}', '', text)
-    text = re.sub(r'[{}]', '', text)
-    text = remove_consecutive_nonword(text)
-    return text.strip(" -_.")
-
-
-def remove_consecutive_nonword(text: str):
-    for _ in range(0, 10):
-        m = re.findall(r'(\W+)\1+', text)
-        if m:
-            text = re.sub(r'(\W+)\1+', r'\1', text)
-        else:
-            break
-    return text
-
-
-def field_replacer(text: str, scene_information:dict):
-    field_found = re.findall(r"\$\w+", text)
-    result = text
-    title = None
-    replaced_word = ""
-    if field_found:
-        field_found.sort(key=len, reverse=True)
-    for i in range(0, len(field_found)):
-        f = field_found[i].replace("$", "").strip("_")
-        # If $performer is before $title, prevent having duplicate text.
-        if f == "performer" and len(field_found) > i + 1 and scene_information.get('performer'):
-            if field_found[i+1] == "$title" and scene_information.get('title') and PREVENT_TITLE_PERF:
-                if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
-                    log.LogDebug("Ignoring the performer field because it's already in start of title")
-                    result = result.replace("$performer", "")
-                    continue
-        replaced_word = scene_information.get(f)
-        if not replaced_word:
-            replaced_word = ""
-        if FIELD_REPLACER.get(f"${f}"):
-            replaced_word = replaced_word.replace(FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"])
-        if f == "title":
-            title = replaced_word.strip()
-            continue
-        if replaced_word == "":
-            result = result.replace(field_found[i], replaced_word)
-        else:
-            result = result.replace(f"${f}", replaced_word)
-    return result, title
-
-
-def makeFilename(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    r, t = field_replacer(new_filename, scene_information)
-    if FILENAME_REPLACEWORDS:
-        r = replace_text(r)
-    if not t:
-        r = r.replace("$title", "")
-    r = cleanup_text(r)
-    if t:
-        r = r.replace("$title", t)
-    # Replace spaces with splitchar
-    r = r.replace(' ', FILENAME_SPLITCHAR)
-    return r
-
-
-def makePath(scene_information: dict, query: str) -> str:
-    new_filename = str(query)
-    new_filename = new_filename.replace("$performer", "$performer_path")
-    r, t = field_replacer(new_filename, scene_information)
-    if not t:
-        r = r.replace("$title", "")
-    r = cleanup_text(r)
-    if t:
-        r = r.replace("$title", t)
-    return r
-
-
 def capitalizeWords(s: str):
     # thanks to BCFC_1982 for it
     return re.sub(r"[A-Za-z]+('[A-Za-z]+)?", lambda word: word.group(0).capitalize(), s)
 
 
 def create_new_filename(scene_info: dict, template: str):
-    new_filename = makeFilename(scene_info, template) + DUPLICATE_SUFFIX[scene_info['file_index']] + scene_info['file_extension']
+    new_filename = TEMPLATE_RENDERER.filename(scene_info, template) + DUPLICATE_SUFFIX[scene_info['file_index']] + scene_info['file_extension']
     if FILENAME_LOWER:
         new_filename = new_filename.lower()
     if FILENAME_TITLECASE:
@@ -792,6 +993,7 @@ def create_new_filename(scene_info: dict, template: str):
 
     # Trying to remove non standard character
     if MODULE_UNIDECODE and UNICODE_USE:
+        import unidecode
         new_filename = unidecode.unidecode(new_filename, errors='preserve')
     else:
         # Using typewriter for Apostrophe
@@ -822,7 +1024,7 @@ def create_new_path(scene_info: dict, template: dict):
             for p in scene_info["studio_hierarchy"]:
                 path_list.append(re.sub('[\\/:"*?<>|]+', '', p).strip())
         else:
-            path_list.append(re.sub('[\\/:"*?<>|]+', '', makePath(scene_info, part)).strip())
+            path_list.append(re.sub('[\\/:"*?<>|]+', '', TEMPLATE_RENDERER.path(scene_info, part)).strip())
     # Remove blank, empty string
     path_split = [x for x in path_list if x]
     # The first character was a seperator, so put it back.
@@ -858,7 +1060,290 @@ def connect_db(path: str):
     return sqliteConnection
 
 
-def checking_duplicate_db(scene_info: dict):
+def connect_db_readonly(path: str):
+    try:
+        sqliteConnection = sqlite3.connect(f"file:{urllib.request.pathname2url(path)}?mode=ro", uri=True, timeout=10)
+        log.LogDebug("Python successfully connected to SQLite (read-only)")
+    except sqlite3.Error as error:
+        log.LogError(f"FATAL SQLITE Error: {error}")
+        return None
+    return sqliteConnection
+
+
+class PathIndex:
+    # every scene file path of the library, used by bulk to check duplicates in memory.
+    # it's updated with each planned rename, so 2 scenes of the same run can't get the same path.
+    def __init__(self):
+        self.paths = {}
+        self.basenames = {}
+
+    @staticmethod
+    def _add(index: dict, key: str, scene_id: str):
+        ids = index.get(key)
+        if ids is None:
+            index[key] = {scene_id}
+        else:
+            ids.add(scene_id)
+
+    @staticmethod
+    def _remove(index: dict, key: str, scene_id: str):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(scene_id)
+            if not ids:
+                del index[key]
+
+    def add(self, path: str, scene_id):
+        self._add(self.paths, os.path.normcase(path), str(scene_id))
+        self._add(self.basenames, os.path.normcase(os.path.basename(path)), str(scene_id))
+
+    def remove(self, path: str, scene_id):
+        self._remove(self.paths, os.path.normcase(path), str(scene_id))
+        self._remove(self.basenames, os.path.normcase(os.path.basename(path)), str(scene_id))
+
+    def move(self, scene_id, old_path: str, new_path: str):
+        self.remove(old_path, scene_id)
+        self.add(new_path, scene_id)
+
+    def scenes_at(self, path: str) -> set:
+        return self.paths.get(os.path.normcase(path), set())
+
+    def scenes_named(self, basename: str) -> set:
+        return self.basenames.get(os.path.normcase(basename), set())
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def load_path_index():
+    stash_db = connect_db_readonly(STASH_DATABASE)
+    if stash_db is None:
+        return None
+    path_index = PathIndex()
+    cursor = stash_db.cursor()
+    try:
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            cursor.execute("""
+                SELECT scenes_files.scene_id, folders.path, files.basename FROM scenes_files
+                JOIN files ON files.id = scenes_files.file_id
+                JOIN folders ON folders.id = files.parent_folder_id
+            """)
+            for scene_id, folder, basename in cursor:
+                path_index.add(os.path.join(folder, basename), scene_id)
+        else:
+            cursor.execute("SELECT id, path FROM scenes")
+            for scene_id, path in cursor:
+                path_index.add(path, scene_id)
+    except sqlite3.Error as error:
+        log.LogWarning(f"Can't build the path index, using GraphQL to find duplicates ({error})")
+        path_index = None
+    finally:
+        cursor.close()
+        stash_db.close()
+    if path_index is not None:
+        log.LogDebug(f"[Duplicate] {len(path_index)} paths indexed")
+    return path_index
+
+
+class SqliteSceneReader:
+    # bulk_source = "sqlite": the task renamer and 'Plan rename' read the scenes from the database file
+    # (read-only) instead of GraphQL. A page is read with one query per table for all its scenes and
+    # gives the same scenes as findScenes, with only the objects asked by SCENE_FIELDS.
+    TABLES = {
+        "scene": ["scenes", "scenes_files", "files", "folders", "files_fingerprints", "video_files"],
+        "studio {": ["studios"],
+        "tags {": ["tags", "scenes_tags"],
+        "performers {": ["performers", "performers_scenes"],
+        "stash_ids{": ["performer_stash_ids"],
+        "movies {": ["movies", "movies_scenes"],
+        "stash_ids {": ["scene_stash_ids"],
+    }
+    # parameters per query, the old SQLite versions are limited to 999
+    CHUNK_SIZE = 900
+
+    def __init__(self, stash_db: sqlite3.Connection):
+        self.db = stash_db
+        self.fields = {key for key in self.TABLES if key == "scene" or key in SCENE_FIELDS}
+
+    @classmethod
+    def connect(cls, path: str):
+        # None if the database can't be used, the scenes are then asked to Stash
+        if DB_VERSION < DB_VERSION_FILE_REFACTOR:
+            log.LogWarning(f"[SQLITE] bulk_source 'sqlite' needs the database version {DB_VERSION_FILE_REFACTOR} (yours: {DB_VERSION}), using GraphQL")
+            return None
+        stash_db = connect_db_readonly(path)
+        if stash_db is None:
+            return None
+        reader = cls(stash_db)
+        tables = {row[0] for row in stash_db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        missing = sorted({t for key in reader.fields for t in cls.TABLES[key]} - tables)
+        if missing:
+            log.LogWarning(f"[SQLITE] Table(s) {', '.join(missing)} not found, using GraphQL")
+            stash_db.close()
+            return None
+        return reader
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def rating(value):
+        # the database has the rating on 100 since the version 40, 'rating' of GraphQL is on 5
+        if value is None or DB_VERSION < DB_VERSION_RATING100:
+            return value
+        return int(value / 20 + 0.5)
+
+    def studios(self):
+        # same as findStudios
+        studios = {}
+        for studio_id, name, parent_id in self.db.execute("SELECT id, name, parent_id FROM studios"):
+            studios[str(studio_id)] = {"id": str(studio_id), "name": name, "parent_studio": {"id": str(parent_id)} if parent_id else None}
+        return studios
+
+    def _query(self, sql: str, ids: list):
+        # sql has a '{ids}' placeholder for the list of ids
+        for start in range(0, len(ids), self.CHUNK_SIZE):
+            chunk = ids[start:start + self.CHUNK_SIZE]
+            yield from self.db.execute(sql.format(ids=",".join("?" * len(chunk))), chunk)
+
+    def scene_ids(self, scene_filter=None):
+        # every scene in the order of the task renamer (created_at), updated after the watermark if any
+        if not (scene_filter and scene_filter.get("updated_at")):
+            return [row[0] for row in self.db.execute("SELECT id FROM scenes ORDER BY created_at, id")]
+        watermark = parse_timestamp(scene_filter["updated_at"]["value"])
+        # Compared in SQL as unix seconds (strftime converts the offset to UTC and drops the fraction,
+        # like parse_timestamp). A value SQLite can't read is returned and compared in Python.
+        ids = []
+        for scene_id, unknown_format in self.db.execute(
+            "SELECT id, CASE WHEN strftime('%s', updated_at) IS NULL THEN updated_at END FROM scenes "
+            "WHERE updated_at IS NOT NULL AND (strftime('%s', updated_at) IS NULL OR CAST(strftime('%s', updated_at) AS INTEGER) > ?) "
+            "ORDER BY created_at, id", [int(watermark.timestamp())]
+        ):
+            if unknown_format is None or parse_timestamp(str(unknown_format)) > watermark:
+                ids.append(scene_id)
+        return ids
+
+    def scenes(self, ids: list):
+        code = ", scenes.code" if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE else ""
+        scenes = {}
+        for row in self._query(f"SELECT id, title, date, rating, organized, updated_at, studio_id{code} FROM scenes WHERE id IN ({{ids}})", ids):
+            scene = {
+                "id": str(row[0]),
+                "title": row[1],
+                "date": row[2],
+                "rating": self.rating(row[3]),
+                "organized": bool(row[4]),
+                "updated_at": parse_timestamp(str(row[5])).isoformat() if row[5] else None,
+                "files": [],
+            }
+            if code:
+                scene["code"] = row[7]
+            scenes[row[0]] = (scene, row[6])
+        files = {}
+        for scene_id, file_id, folder, basename, *video in self._query(
+            """SELECT scenes_files.scene_id, files.id, folders.path, files.basename, video_files.video_codec, video_files.audio_codec,
+            video_files.width, video_files.height, video_files.frame_rate, video_files.duration, video_files.bit_rate
+            FROM scenes_files JOIN files ON files.id = scenes_files.file_id
+            JOIN folders ON folders.id = files.parent_folder_id
+            LEFT JOIN video_files ON video_files.file_id = files.id
+            WHERE scenes_files.scene_id IN ({ids}) ORDER BY scenes_files.scene_id, scenes_files."primary" DESC, files.id""", ids
+        ):
+            scene_file = dict(zip(("video_codec", "audio_codec", "width", "height", "frame_rate", "duration", "bit_rate"), video))
+            scene_file["path"] = os.path.join(folder, basename)
+            scene_file["fingerprints"] = []
+            files[file_id] = scene_file
+            scenes[scene_id][0]["files"].append(scene_file)
+        for file_id, fingerprint_type, value in self._query(
+            "SELECT file_id, type, fingerprint FROM files_fingerprints WHERE file_id IN ({ids})", list(files)
+        ):
+            files[file_id]["fingerprints"].append({"type": fingerprint_type, "value": str(value)})
+        for scene, _ in scenes.values():
+            # the fingerprints of the primary file
+            for f in scene["files"][0]["fingerprints"] if scene["files"] else []:
+                if f["type"] in ("oshash", "md5"):
+                    scene["oshash" if f["type"] == "oshash" else "checksum"] = f["value"]
+        if "studio {" in self.fields:
+            for scene, studio_id in scenes.values():
+                studio = STUDIO_CACHE.get(str(studio_id)) if studio_id else None
+                scene["studio"] = None
+                if studio:
+                    parent = STUDIO_CACHE.get(studio["parent_studio"]["id"]) if studio.get("parent_studio") else None
+                    scene["studio"] = {
+                        "id": studio["id"],
+                        "name": studio["name"],
+                        "parent_studio": {"id": parent["id"], "name": parent["name"]} if parent else None
+                    }
+        if "stash_ids {" in self.fields:
+            for scene, _ in scenes.values():
+                scene["stash_ids"] = []
+            for scene_id, endpoint, stash_id in self._query("SELECT scene_id, endpoint, stash_id FROM scene_stash_ids WHERE scene_id IN ({ids})", ids):
+                scenes[scene_id][0]["stash_ids"].append({"endpoint": endpoint, "stash_id": stash_id})
+        if "tags {" in self.fields:
+            for scene, _ in scenes.values():
+                scene["tags"] = []
+            for scene_id, tag_id, name in self._query(
+                "SELECT scenes_tags.scene_id, tags.id, tags.name FROM scenes_tags JOIN tags ON tags.id = scenes_tags.tag_id WHERE scenes_tags.scene_id IN ({ids}) ORDER BY scenes_tags.scene_id, tags.id", ids
+            ):
+                scenes[scene_id][0]["tags"].append({"id": str(tag_id), "name": name})
+        if "performers {" in self.fields:
+            performers = {}
+            for scene, _ in scenes.values():
+                scene["performers"] = []
+            for scene_id, performer_id, name, gender, favorite, rating in self._query(
+                """SELECT performers_scenes.scene_id, performers.id, performers.name, performers.gender, performers.favorite, performers.rating
+                FROM performers_scenes JOIN performers ON performers.id = performers_scenes.performer_id
+                WHERE performers_scenes.scene_id IN ({ids}) ORDER BY performers_scenes.scene_id, performers.id""", ids
+            ):
+                performer = {"id": str(performer_id), "name": name, "gender": gender, "favorite": bool(favorite), "rating": self.rating(rating)}
+                performers.setdefault(performer_id, []).append(performer)
+                scenes[scene_id][0]["performers"].append(performer)
+            if "stash_ids{" in self.fields:
+                for performer in (p for same in performers.values() for p in same):
+                    performer["stash_ids"] = []
+                for performer_id, endpoint, stash_id in self._query(
+                    "SELECT performer_id, endpoint, stash_id FROM performer_stash_ids WHERE performer_id IN ({ids})", list(performers)
+                ):
+                    for performer in performers[performer_id]:
+                        performer["stash_ids"].append({"endpoint": endpoint, "stash_id": stash_id})
+        if "movies {" in self.fields:
+            for scene, _ in scenes.values():
+                scene["movies"] = []
+            for scene_id, name, date, scene_index in self._query(
+                """SELECT movies_scenes.scene_id, movies.name, movies.date, movies_scenes.scene_index
+                FROM movies_scenes JOIN movies ON movies.id = movies_scenes.movie_id WHERE movies_scenes.scene_id IN ({ids})""", ids
+            ):
+                scenes[scene_id][0]["movies"].append({"movie": {"name": name, "date": date}, "scene_index": scene_index})
+        return [scenes[scene_id][0] for scene_id in ids if scene_id in scenes]
+
+    def iter_scenes(self, perPage, page=1, scene_filter=None):
+        # same as graphql_iterScenes
+        ids = self.scene_ids(scene_filter)
+        while (page - 1) * perPage < len(ids):
+            yield page, len(ids), self.scenes(ids[(page - 1) * perPage:page * perPage])
+            page += 1
+
+
+def iter_scenes(perPage, page=1, scene_filter=None):
+    if SCENE_READER is not None:
+        return SCENE_READER.iter_scenes(perPage, page, scene_filter)
+    return graphql_iterScenes(perPage, page, scene_filter)
+
+
+def checking_duplicate_db(scene_info: dict, path_index=None):
+    if path_index is not None:
+        dupl = path_index.scenes_at(scene_info['final_path'])
+        if os.path.normcase(scene_info['final_path']) == os.path.normcase(scene_info['current_path']):
+            # only the case changes (Windows), the path is used by the file itself
+            dupl = {dupl_id for dupl_id in dupl if dupl_id != str(scene_info['scene_id'])}
+        if dupl:
+            log.LogError("Duplicate path detected")
+            for dupl_id in dupl:
+                log.LogWarning(f"Identical path: [{dupl_id}]")
+            return 1
+        for dupl_id in path_index.scenes_named(scene_info['new_filename']):
+            if dupl_id != str(scene_info['scene_id']):
+                log.LogWarning(f"Duplicate filename: [{dupl_id}]")
+        return
     scenes = graphql_findScenebyPath(scene_info['final_path'], "EQUALS")
     if scenes["count"] > 0:
         log.LogError("Duplicate path detected")
@@ -941,99 +1426,636 @@ def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
         raise Exception(f"You need to setup a library with the new location ({scene_info['new_directory']}) and scan at least 1 file")
 
 
-def file_rename(current_path: str, new_path: str, scene_info: dict):
+class DatabaseWriter:
+    # Bulk database updates. The folders are cached (path -> id), the updates are queued
+    # and written in one transaction per batch, each file in its own savepoint:
+    # a file that fails only rolls back its savepoint and its move is reverted.
+    def __init__(self, stash_db: sqlite3.Connection, batch_size=100):
+        self.db = stash_db
+        # explicit transactions
+        self.db.isolation_level = None
+        self.batch_size = max(batch_size, 1)
+        self.pending = []
+        self.folders = {}
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            cursor = self.db.execute("SELECT id, path FROM folders")
+            for folder_id, path in cursor:
+                self.folders[path] = folder_id
+            cursor.close()
+            log.LogDebug(f"[SQLITE] {len(self.folders)} folders cached")
+
+    def queue(self, scene_info: dict, on_success=None, on_error=None):
+        self.pending.append((scene_info, on_success, on_error))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        done = []
+        failed = []
+        batch_folders = []
+        # a batch is not the time of one scene
+        STATS.scene(None)
+        start = time.perf_counter()
+        cursor = self.db.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            self.next_folder_id = None
+            self.mod_time = datetime.now().astimezone().isoformat('T', 'seconds')
+            for item in pending:
+                new_folders = []
+                cursor.execute("SAVEPOINT rename_file")
+                try:
+                    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                        self._rename_refactor(cursor, item[0], new_folders)
+                    else:
+                        cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [item[0]['final_path'], item[0]['scene_id']])
+                    cursor.execute("RELEASE rename_file")
+                    batch_folders.extend(new_folders)
+                    done.append(item)
+                except Exception as err:
+                    cursor.execute("ROLLBACK TO rename_file")
+                    cursor.execute("RELEASE rename_file")
+                    for path in new_folders:
+                        del self.folders[path]
+                    failed.append((item, err))
+            cursor.execute("COMMIT")
+            log.LogDebug(f"[SQLITE] {len(done)} file(s) updated in one transaction")
+        except sqlite3.Error as err:
+            # the whole batch is lost
+            if self.db.in_transaction:
+                cursor.execute("ROLLBACK")
+            for path in batch_folders:
+                del self.folders[path]
+            failed.extend((item, err) for item in done)
+            done = []
+        finally:
+            cursor.close()
+        STATS.add("database", time.perf_counter() - start)
+        for scene_info, on_success, _ in done:
+            if on_success:
+                on_success(scene_info)
+        for (scene_info, _, on_error), err in failed:
+            log.LogError(f"[{scene_info['scene_id']}] error when trying to update the database ({err}), revert the move...")
+            if on_error:
+                on_error(scene_info)
+
+    def _folder_id(self, cursor: sqlite3.Cursor, path: str):
+        folder_id = self.folders.get(path)
+        if folder_id is None:
+            # created after the cache was loaded (scan running)
+            cursor.execute("SELECT id FROM folders WHERE path=?", [path])
+            row = cursor.fetchone()
+            if row:
+                folder_id = self.folders[path] = row[0]
+        return folder_id
+
+    def _create_folder(self, cursor: sqlite3.Cursor, path: str, new_folders: list):
+        # create the missing folders down from the first parent found
+        missing = []
+        parent_id = None
+        folder = path
+        while True:
+            missing.append(folder)
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                break
+            folder = parent
+            parent_id = self._folder_id(cursor, folder)
+            if parent_id:
+                break
+        if not parent_id:
+            raise Exception(f"You need to setup a library with the new location ({path}) and scan at least 1 file")
+        if self.next_folder_id is None:
+            # one MAX(id) per batch, the transaction prevents another writer
+            cursor.execute("SELECT MAX(id) FROM folders")
+            self.next_folder_id = (cursor.fetchone()[0] or 0) + 1
+        for folder in reversed(missing):
+            cursor.execute(
+                "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
+                [self.next_folder_id, folder, parent_id, self.mod_time, self.mod_time, self.mod_time, None]
+            )
+            parent_id = self.folders[folder] = self.next_folder_id
+            new_folders.append(folder)
+            self.next_folder_id += 1
+        return parent_id
+
+    def _rename_refactor(self, cursor: sqlite3.Cursor, scene_info: dict, new_folders: list):
+        old_folder_id = self._folder_id(cursor, scene_info['current_directory'])
+        folder_id = self._folder_id(cursor, scene_info['new_directory'])
+        if not folder_id:
+            folder_id = self._create_folder(cursor, scene_info['new_directory'], new_folders)
+        cursor.execute(
+            """SELECT files.id FROM scenes_files JOIN files ON files.id = scenes_files.file_id
+            WHERE scenes_files.scene_id=? AND files.parent_folder_id=? AND files.basename=?""",
+            [scene_info['scene_id'], old_folder_id, scene_info['current_filename']]
+        )
+        file_id = cursor.fetchone()
+        if not file_id:
+            raise Exception("Failed to find file_id")
+        cursor.execute("UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;", [scene_info['new_filename'], folder_id, self.mod_time, file_id[0]])
+
+
+def oshash(path: str):
+    # same as Stash: size + sum of the 64-bit words of the first and last 64KiB
+    size = os.path.getsize(path)
+    checksum = size
+    with open(path, 'rb') as f:
+        head = f.read(OSHASH_CHUNK_SIZE)
+        f.seek(max(size - OSHASH_CHUNK_SIZE, 0))
+        tail = f.read(OSHASH_CHUNK_SIZE)
+    for chunk in (head, tail):
+        chunk = chunk[:len(chunk) - len(chunk) % 8]
+        checksum += sum(struct.unpack(f"<{len(chunk) // 8}Q", chunk))
+    return f"{checksum & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def copy_data(f_src, f_dst, offset: int, size: int, on_chunk):
+    # kernel copy when possible (copy_file_range, then sendfile), else a large buffer
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append("copy_file_range")
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        methods.append("sendfile")
+    buffer = None
+    copied = offset
+    while copied < size:
+        count = min(COPY_CHUNK_SIZE, size - copied)
+        if methods:
+            try:
+                if methods[0] == "copy_file_range":
+                    n = os.copy_file_range(f_src.fileno(), f_dst.fileno(), count, copied)
+                else:
+                    n = os.sendfile(f_dst.fileno(), f_src.fileno(), copied, count)
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                log.LogDebug(f"[Copy] {methods[0]} not available ({err})")
+                methods.pop(0)
+                continue
+        else:
+            if buffer is None:
+                buffer = memoryview(bytearray(COPY_CHUNK_SIZE))
+            f_src.seek(copied)
+            f_dst.seek(copied)
+            n = f_src.readinto(buffer[:count])
+            written = 0
+            while written < n:
+                written += f_dst.write(buffer[written:n])
+        if n == 0:
+            raise OSError(f"the file is smaller than expected ({copied}/{size} bytes)")
+        copied += n
+        on_chunk(copied)
+    return copied
+
+
+def transfer_file(current_path: str, new_path: str, expected_oshash=None, on_progress=None):
+    # Move to another device: copy to a .part file, verify it then delete the source.
+    # An interrupted copy leaves the .part file, the next run continues from its end.
+    part_path = new_path + ".part"
+    size = os.path.getsize(current_path)
+    offset = 0
+    if os.path.isfile(part_path):
+        offset = os.path.getsize(part_path)
+        if offset > size:
+            offset = 0
+        else:
+            log.LogInfo(f"[Copy] Resuming the copy at {offset * 100 // max(size, 1)}% ({part_path})")
+    name = os.path.basename(new_path)
+    last = {"time": time.time(), "bytes": offset}
+
+    def on_chunk(copied):
+        if on_progress:
+            on_progress(copied - last["bytes"])
+        else:
+            log.LogProgress(copied / size)
+        last["bytes"] = copied
+        if time.time() - last["time"] >= 5:
+            last["time"] = time.time()
+            log.LogInfo(f"[Copy] {name}: {copied * 100 // size}% ({copied >> 20}/{size >> 20} MiB)")
+
+    start = time.time()
+    with open(current_path, 'rb', buffering=0) as f_src, open(part_path, 'r+b' if offset else 'wb', buffering=0) as f_dst:
+        f_dst.truncate(offset)
+        f_dst.seek(offset)
+        copy_data(f_src, f_dst, offset, size, on_chunk)
+        os.fsync(f_dst.fileno())
+    shutil.copystat(current_path, part_path)
+    # the source is only deleted if the copy is the same file
+    checksum = oshash(part_path)
+    if checksum != expected_oshash:
+        source_checksum = oshash(current_path)
+        if checksum != source_checksum:
+            os.remove(part_path)
+            raise OSError(f"Copy verification failed, oshash {checksum} instead of {source_checksum} ({part_path})")
+        if expected_oshash:
+            log.LogWarning(f"[Copy] The file changed since the last scan (oshash {source_checksum}, Stash has {expected_oshash})")
+    # os.replace overwrites, a file can have been created there during the copy
+    if os.path.exists(new_path):
+        raise FileExistsError(f"A file already exists at the new path, the copy is kept ({part_path})")
+    os.replace(part_path, new_path)
+    try:
+        os.remove(current_path)
+    except OSError:
+        # keep only one file, the source is still the one in the database
+        os.remove(new_path)
+        raise
+    elapsed = max(time.time() - start, 0.001)
+    log.LogDebug(f"[Copy] {name}: {(size - offset) >> 20} MiB copied in {elapsed:.1f}s ({(size - offset) / elapsed / (1 << 20):.1f} MiB/s)")
+    return size - offset
+
+
+def move_file(current_path: str, new_path: str, scene_info: dict, on_progress=None):
+    # shutil.move would copy blindly between 2 devices
+    with STATS.phase("move"):
+        if os.stat(current_path).st_dev == os.stat(os.path.dirname(new_path)).st_dev:
+            shutil.move(current_path, new_path)
+        else:
+            copied = transfer_file(current_path, new_path, scene_info.get('oshash'), on_progress)
+            STATS.count("moved_crossdevice")
+            STATS.count("bytes_moved", copied)
+
+
+def file_rename(current_path: str, new_path: str, scene_info: dict, remove_empty=True, on_progress=None):
     # OS Rename
     if not os.path.isfile(current_path):
         log.LogWarning(f"[OS] File doesn't exist in your Disk/Drive ({current_path})")
         return 1
+    # shutil.move overwrites the destination on POSIX (only a case change can be the same file)
+    if os.path.exists(new_path) and not os.path.samefile(current_path, new_path):
+        log.LogError(f"[OS] A file already exists at the new path, it won't be overwritten ({new_path})")
+        return 1
     # moving/renaming
     new_dir = os.path.dirname(new_path)
     current_dir = os.path.dirname(current_path)
     if not os.path.exists(new_dir):
         log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
-        os.makedirs(new_dir)
+        # another bulk move can create it at the same time
+        os.makedirs(new_dir, exist_ok=True)
     try:
-        shutil.move(current_path, new_path)
-    except PermissionError as err:
-        if "[WinError 32]" in str(err) and MODULE_PSUTIL:
+        move_file(current_path, new_path, scene_info, on_progress)
+    except OSError as err:
+        if file_in_use(err) and HANDLE_MAP.available:
             log.LogWarning("A process is using this file (Probably FFMPEG), trying to find it ...")
             # Find which process accesses the file, it's ffmpeg for sure...
             process_use = has_handle(current_path, PROCESS_ALLRESULT)
             if process_use:
                 # Terminate the process then try again to rename
                 log.LogDebug(f"Process that uses this file: {process_use}")
-                if PROCESS_KILL:
-                    p = psutil.Process(process_use.pid)
-                    p.terminate()
-                    p.wait(10)
+                if PROCESS_KILL and MODULE_PSUTIL:
+                    import psutil
+                    for pid in process_use:
+                        try:
+                            p = psutil.Process(pid)
+                            p.terminate()
+                            p.wait(10)
+                        except psutil.Error as err:
+                            log.LogWarning(f"Failed to terminate the process {pid} ({err})")
+                    HANDLE_MAP.forget(current_path)
                     # If process is not terminated, this will create an error again.
                     try:
-                        shutil.move(current_path, new_path)
+                        move_file(current_path, new_path, scene_info, on_progress)
                     except Exception as err:
                         log.LogError(f"Something still prevents renaming the file. {err}")
                         return 1
                 else:
                     log.LogError("A process prevents renaming the file.")
                     return 1
-        else:
+        elif file_in_use(err) or isinstance(err, PermissionError):
             log.LogError(f"Something prevents renaming the file. {err}")
             return 1
+        else:
+            raise
     # checking if the move/rename work correctly
     if os.path.isfile(new_path):
         log.LogInfo(f"[OS] File Renamed! ({current_path} -> {new_path})")
         if LOGFILE:
             try:
-                with open(LOGFILE, 'a', encoding='utf-8') as f:
-                    f.write(f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}\n")
+                write_logfile([f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}"])
             except Exception as err:
                 shutil.move(new_path, current_path)
                 log.LogError(f"Restoring the original path, error writing the logfile: {err}")
                 return 1
-        if REMOVE_EMPTY_FOLDER:
-            with os.scandir(current_dir) as it:
-                if not any(it):
-                    log.LogInfo(f"Removing empty folder ({current_dir})")
-                    try:
-                        os.rmdir(current_dir)
-                    except Exception as err:
-                        log.logWarning(f"Fail to delete empty folder {current_dir} - {err}")
+        if REMOVE_EMPTY_FOLDER and remove_empty:
+            prune_empty_folders([current_dir], STASH_ROOTS)
     else:
         # I don't think it's possible.
         log.LogError(f"[OS] Failed to rename the file ? {new_path}")
         return 1
 
-def associated_rename(scene_info: dict):
+def write_logfile(lines: list):
+    global LOGFILE_RUN_WRITTEN
+    with LOGFILE_LOCK, open(LOGFILE, 'a', encoding='utf-8') as f:
+        if not LOGFILE_RUN_WRITTEN:
+            f.write(f"#RUN|{RUN_ID}|{datetime.now().astimezone().isoformat('T', 'seconds')}|{PLUGIN_ARGS or 'hook'}\n")
+            LOGFILE_RUN_WRITTEN = True
+        f.write("".join(f"{line}\n" for line in lines))
+
+
+def remove_empty_folder(path: str):
+    try:
+        with os.scandir(path) as it:
+            if any(it):
+                return False
+        log.LogInfo(f"Removing empty folder ({path})")
+        os.rmdir(path)
+        return True
+    except Exception as err:
+        log.LogWarning(f"Fail to delete empty folder {path} - {err}")
+        return False
+
+
+def prune_empty_folders(folders, roots=()):
+    # Deepest first, so a parent emptied by the removal of its subfolders is removed in the same sweep.
+    # The parents are only removed inside a library (stashes of the Stash config), never the library itself.
+    key = os.path.normcase
+    roots = {key(os.path.normpath(root)) for root in roots if root}
+    prefixes = tuple(root if root.endswith(os.sep) else root + os.sep for root in roots)
+    pending = [(-path.count(os.sep), path) for path in {os.path.normpath(folder) for folder in folders}]
+    heapq.heapify(pending)
+    seen = {path for _, path in pending}
+    removed = 0
+    while pending:
+        _, path = heapq.heappop(pending)
+        if key(path) in roots or not os.path.isdir(path) or not remove_empty_folder(path):
+            continue
+        removed += 1
+        parent = os.path.dirname(path)
+        if parent not in seen and key(parent).startswith(prefixes):
+            seen.add(parent)
+            heapq.heappush(pending, (-parent.count(os.sep), parent))
+    return removed
+
+
+class MoveExecutor:
+    # Bulk moves run in threads. A rename on the same device only changes metadata, they all
+    # run in the same pool. A move to another device is a copy, each (source, destination)
+    # device pair gets its own pool limited to move_crossdevice_concurrency.
+    # The results come back to the main thread (drain), the database is only updated there.
+    def __init__(self, workers=8, crossdevice_concurrency=1):
+        self.workers = max(workers, 1)
+        self.crossdevice_concurrency = max(crossdevice_concurrency, 1)
+        self.rename_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rename")
+        self.copy_pools = {}
+        self.devices = {}
+        self.results = queue.Queue()
+        self.in_flight = 0
+        self.source_dirs = set()
+        # overall progress of the cross-device copies
+        self.copy_lock = threading.Lock()
+        self.copy_total = 0
+        self.copy_done = 0
+        self.copy_logged = time.time()
+
+    def device(self, path: str):
+        # device of the path, or of its first existing parent (the folder can be created by the move)
+        folder = path
+        missing = []
+        while folder not in self.devices:
+            try:
+                self.devices[folder] = os.stat(folder).st_dev
+                break
+            except OSError:
+                missing.append(folder)
+                parent = os.path.dirname(folder)
+                if parent == folder:
+                    self.devices[folder] = None
+                    break
+                folder = parent
+        for m in missing:
+            self.devices[m] = self.devices[folder]
+        return self.devices[folder]
+
+    def submit(self, scene_info: dict, on_done):
+        src = self.device(scene_info['current_directory'])
+        dst = self.device(scene_info['new_directory'])
+        if src == dst:
+            pool = self.rename_pool
+        else:
+            pool = self.copy_pools.get((src, dst))
+            if pool is None:
+                log.LogDebug(f"[Move] New device pair {src} -> {dst}")
+                pool = self.copy_pools[(src, dst)] = concurrent.futures.ThreadPoolExecutor(max_workers=self.crossdevice_concurrency, thread_name_prefix="copy")
+            try:
+                size = os.path.getsize(scene_info['current_path'])
+            except OSError:
+                size = 0
+            with self.copy_lock:
+                self.copy_total += size
+        self.in_flight += 1
+        pool.submit(self._move, scene_info, on_done)
+
+    def _copy_progress(self, copied: int):
+        with self.copy_lock:
+            self.copy_done += copied
+            if time.time() - self.copy_logged < 10:
+                return
+            self.copy_logged = time.time()
+            done, total = self.copy_done, max(self.copy_total, 1)
+        log.LogInfo(f"[Copy] Overall: {done * 100 // total}% ({done >> 20}/{total >> 20} MiB)")
+
+    def _move(self, scene_info: dict, on_done):
+        STATS.scene(scene_info['scene_id'])
+        try:
+            # the empty folders are removed by the main thread, another move can still use them
+            err = file_rename(scene_info['current_path'], scene_info['final_path'], scene_info, remove_empty=False, on_progress=self._copy_progress)
+            if err:
+                err = Exception("rename")
+            elif scene_info['file_index'] == 0:
+                # the associated files follow in the same task
+                scene_info['associated'] = associated_rename(scene_info, SIDECAR_INDEX)
+        except Exception as e:
+            err = e
+        self.results.put((scene_info, on_done, err))
+
+    def drain(self, wait=False):
+        # run the callbacks of the finished moves, wait=True waits for all of them
+        while self.in_flight:
+            try:
+                scene_info, on_done, err = self.results.get(block=wait)
+            except queue.Empty:
+                return
+            self.in_flight -= 1
+            if not err:
+                self.source_dirs.add(scene_info['current_directory'])
+            on_done(scene_info, err)
+
+    def remove_empty_folders(self):
+        # once at the end of the run, a folder emptied by a move can be used by another one
+        if REMOVE_EMPTY_FOLDER and self.source_dirs:
+            removed = prune_empty_folders(self.source_dirs, STASH_ROOTS)
+            log.LogDebug(f"[Move] {len(self.source_dirs)} source folder(s) checked, {removed} empty folder(s) removed")
+        self.source_dirs.clear()
+
+    def shutdown(self):
+        self.drain(wait=True)
+        self.rename_pool.shutdown()
+        for pool in self.copy_pools.values():
+            pool.shutdown()
+        if self.copy_total:
+            log.LogInfo(f"[Copy] {self.copy_done >> 20} MiB copied to another device")
+
+
+class SidecarIndex:
+    # Associated files (subtitles, funscript...) found with one scandir per source folder instead of
+    # one stat per extension and scene. A file belongs to a video if it starts with the name of the
+    # video without extension, with an associated_extension, and only language codes (ISO 639, with
+    # a region/script) or subtitle flags between them (video.srt, video.en.srt, video.pt-BR.forced.srt).
+    # Any other piece is part of the name of another video (video.Part2.srt is for video.Part2.mp4).
+    RE_TAG = re.compile(r"^(?:[a-z]{2,3}(?:[-_](?:[a-z]{2}|[a-z]{4}|\d{3}))?|forced|default|sdh|cc|hi)$", re.IGNORECASE)
+
+    def __init__(self, extensions: list):
+        self.extensions = {ext.lower() for ext in extensions or []}
+        self.lock = threading.Lock()
+        # folder -> {stem: [(filename, suffix)]}
+        self.folders = {}
+
+    def _scan(self, folder: str):
+        stems = {}
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        self._add(stems, entry.name)
+        except OSError as err:
+            log.LogDebug(f"[Associated] Can't list {folder} ({err})")
+        return stems
+
+    def _add(self, stems: dict, name: str):
+        base, _, ext = name.rpartition(".")
+        if not base or ext.lower() not in self.extensions:
+            return
+        suffix = "." + ext
+        while base:
+            stems.setdefault(os.path.normcase(base), []).append((name, suffix))
+            base, _, tag = base.rpartition(".")
+            if not self.RE_TAG.match(tag):
+                break
+            suffix = f".{tag}{suffix}"
+
+    def find(self, video_path: str):
+        # [(filename, suffix)] of the associated files of the video
+        folder, filename = os.path.split(video_path)
+        with self.lock:
+            stems = self.folders.get(folder)
+        if stems is None:
+            stems = self._scan(folder)
+            with self.lock:
+                stems = self.folders.setdefault(folder, stems)
+        with self.lock:
+            return list(stems.get(os.path.normcase(os.path.splitext(filename)[0]), []))
+
+    def moved(self, old_path: str, new_path: str):
+        with self.lock:
+            stems = self.folders.get(os.path.dirname(old_path))
+            if stems is not None:
+                name = os.path.basename(old_path)
+                for stem in list(stems):
+                    stems[stem] = [f for f in stems[stem] if f[0] != name]
+                    if not stems[stem]:
+                        del stems[stem]
+            stems = self.folders.get(os.path.dirname(new_path))
+            if stems is not None:
+                self._add(stems, os.path.basename(new_path))
+
+
+def associated_rename(scene_info: dict, sidecar_index=None):
+    # bulk/apply use the folder index (one scandir per folder, language tags),
+    # the hook renames one scene and only checks video.<ext> for each associated_extension
+    renamed = []
     if ASSOCIATED_EXT:
-        for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info['current_path'])[0] + "." + ext
-            p_new = os.path.splitext(scene_info['final_path'])[0] + "." + ext
-            if os.path.isfile(p):
-                try:
-                    shutil.move(p, p_new)
-                except Exception as err:
-                    log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
-                    continue
-            if os.path.isfile(p_new):
-                log.LogInfo(f"[OS] Associate file renamed ({p_new})")
-                if LOGFILE:
-                    try:
-                        with open(LOGFILE, 'a', encoding='utf-8') as f:
-                            f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
-                    except Exception as err:
-                        shutil.move(p_new, p)
-                        log.LogError(f"Restoring the original name, error writing the logfile: {err}")
+        start = time.perf_counter()
+        current_base = os.path.splitext(scene_info['current_path'])[0]
+        new_base = os.path.splitext(scene_info['final_path'])[0]
+        if sidecar_index is not None:
+            found = sidecar_index.find(scene_info['current_path'])
+        else:
+            found = []
+            for ext in ASSOCIATED_EXT:
+                if os.path.isfile(f"{current_base}.{ext}"):
+                    found.append((os.path.basename(f"{current_base}.{ext}"), f".{ext}"))
+        for filename, suffix in found:
+            p = os.path.join(scene_info['current_directory'], filename)
+            p_new = new_base + suffix
+            try:
+                shutil.move(p, p_new)
+            except Exception as err:
+                log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
+                continue
+            if sidecar_index is not None:
+                sidecar_index.moved(p, p_new)
+            log.LogInfo(f"[OS] Associate file renamed ({p_new})")
+            renamed.append((p, p_new))
+        if renamed and LOGFILE:
+            try:
+                write_logfile([f"{scene_info['scene_id']}|{p}|{p_new}" for p, p_new in renamed])
+            except Exception as err:
+                log.LogError(f"Restoring the original names, error writing the logfile: {err}")
+                for p, p_new in renamed:
+                    shutil.move(p_new, p)
+                    if sidecar_index is not None:
+                        sidecar_index.moved(p_new, p)
+                renamed = []
+        STATS.add("associated", time.perf_counter() - start)
+    return renamed
+
+
+def revert_rename(scene_info: dict, path_index=None):
+    # the database update failed, put the files back
+    BULK_FAILED.add(scene_info['scene_id'])
+    STATS.scene(scene_info['scene_id'])
+    STATS.count("errors")
+    for p, p_new in scene_info.get('associated', []):
+        try:
+            shutil.move(p_new, p)
+            SIDECAR_INDEX.moved(p_new, p)
+        except Exception as err:
+            log.LogError(f"Failed to restore the associated file '{p_new}' - err: {err}")
+    if file_rename(scene_info['final_path'], scene_info['current_path'], scene_info):
+        log.LogError(f"Failed to restore the file, the database doesn't match it anymore ({scene_info['final_path']})")
+        return
+    if path_index is not None:
+        path_index.move(scene_info['scene_id'], scene_info['final_path'], scene_info['current_path'])
+
+
+def rename_done(scene_info: dict):
+    STATS.scene(scene_info['scene_id'])
+    STATS.count("renamed")
+    if scene_info.get('clean_tag'):
+        graphql_removeScenesTag([scene_info['scene_id']], scene_info['clean_tag'])
+
+
+def move_done(scene_info: dict, err, db_writer: DatabaseWriter, path_index=None):
+    # bulk: called in the main thread when the move is finished, the database is only updated if it worked
+    STATS.scene(scene_info['scene_id'])
+    if err:
+        log.LogError(f"[{scene_info['scene_id']}] Error during the move ({err})")
+        BULK_FAILED.add(scene_info['scene_id'])
+        STATS.count("errors")
+        if path_index is not None:
+            if os.path.isfile(scene_info['final_path']):
+                path_index.remove(scene_info['current_path'], scene_info['scene_id'])
+            else:
+                path_index.remove(scene_info['final_path'], scene_info['scene_id'])
+        return
+    if path_index is not None:
+        # the file is not at its old path anymore, another scene can use it
+        path_index.remove(scene_info['current_path'], scene_info['scene_id'])
+    db_writer.queue(scene_info, on_success=rename_done, on_error=lambda info: revert_rename(info, path_index))
 
 
-def renamer(scene_id, db_conn=None):
+def plan_renames(stash_scene: dict):
+    # render the templates, yield (file index, scene information, template, dry-run option) for each file
+    scene_id = stash_scene['id']
+    STATS.scene(scene_id)
+    STATS.count("scenes_seen")
     option_dryrun = False
-    if type(scene_id) is dict:
-        stash_scene = scene_id
-        scene_id = stash_scene['id']
-    elif type(scene_id) is int:
-        stash_scene = graphql_getScene(scene_id)
-
     if config.only_organized and not stash_scene['organized'] and not PATH_NON_ORGANIZED:
         log.LogDebug(f"[{scene_id}] Scene ignored (not organized)")
+        STATS.count("skipped")
         return
 
     # refractor file support
@@ -1057,15 +2079,15 @@ def renamer(scene_id, db_conn=None):
     elif stash_scene.get("files"):
         scene_files = stash_scene["files"]
         del stash_scene["files"]
-    stash_db = None
     for i in range(0, len(scene_files)):
+        start = time.perf_counter()
         scene_file = scene_files[i]
         # refractor file support
         for f in scene_file["fingerprints"]:
-            if f.get("oshash"):
-                stash_scene["oshash"] = f["oshash"]
-            if f.get("md5"):
-                stash_scene["checksum"] = f["md5"]
+            if f.get("type") == "oshash":
+                stash_scene["oshash"] = f["value"]
+            if f.get("type") == "md5":
+                stash_scene["checksum"] = f["value"]
         stash_scene["path"] = scene_file["path"]
         stash_scene["file"] = scene_file
         if scene_file.get("bit_rate"):
@@ -1094,6 +2116,7 @@ def renamer(scene_id, db_conn=None):
 
         if not template["filename"] and not template["path"]:
             log.LogWarning(f"[{scene_id}] No template for this scene.")
+            STATS.count("skipped")
             return
 
         #log.LogDebug("Using this template: {}".format(filename_template))
@@ -1112,11 +2135,26 @@ def renamer(scene_id, db_conn=None):
         else:
             scene_information['new_directory'] = scene_information['current_directory']
         scene_information['final_path'] = os.path.join(scene_information['new_directory'], scene_information['new_filename'])
+        if template.get("path") and "clean_tag" in template["path"]["option"]:
+            scene_information['clean_tag'] = template["path"]["opt_details"]["clean_tag"]
+        STATS.add("template", time.perf_counter() - start)
+        yield i, scene_information, template, option_dryrun
+
+
+def renamer(scene_id, db_conn=None, path_index=None, executor=None):
+    if type(scene_id) is dict:
+        stash_scene = scene_id
+        scene_id = stash_scene['id']
+    elif type(scene_id) is int:
+        stash_scene = graphql_getScene(scene_id)
+    stash_db = None
+    for i, scene_information, template, option_dryrun in plan_renames(stash_scene):
         # check length of path
         if check_longpath(scene_information['final_path']):
             if (DRY_RUN or option_dryrun) and LOGFILE:
                 with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
                     f.write(f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n")
+            STATS.count("skipped")
             continue
 
         #log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
@@ -1124,6 +2162,7 @@ def renamer(scene_id, db_conn=None):
 
         if scene_information['final_path'] == scene_information['current_path']:
             log.LogInfo(f"Everything is ok. ({scene_information['current_filename']})")
+            STATS.count("skipped")
             continue
 
         if scene_information['current_directory'] != scene_information['new_directory']:
@@ -1139,14 +2178,36 @@ def renamer(scene_id, db_conn=None):
                 log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
                 log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
 
-        if (DRY_RUN or option_dryrun) and LOGFILE:
-            with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n")
+        if DRY_RUN or option_dryrun:
+            STATS.count("skipped")
+            # with the index, the dry-run also shows the scenes of the run that end on the same path
+            if path_index is not None and checking_duplicate_db(scene_information, path_index):
+                if LOGFILE:
+                    with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                        f.write(f"[DUPLICATE] {scene_information['scene_id']}|{scene_information['final_path']}\n")
+                continue
+            if path_index is not None:
+                path_index.move(scene_id, scene_information['current_path'], scene_information['final_path'])
+            if LOGFILE:
+                with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                    f.write(f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n")
             continue
         # check if there is already a file where the new path is
-        err = checking_duplicate_db(scene_information)
+        err = checking_duplicate_db(scene_information, path_index)
         if err:
+            STATS.count("skipped")
             raise Exception("duplicate")
+        if path_index is not None:
+            # reserve the new path, the next scenes can't use it
+            path_index.add(scene_information['final_path'], scene_id)
+            if executor is None:
+                path_index.remove(scene_information['current_path'], scene_id)
+        if executor is not None:
+            # bulk: the move runs in the executor, the database is updated after it (move_done).
+            # The old path stays reserved until the file is moved: a scene going there before
+            # is a duplicate, its move running in parallel could overwrite the file.
+            executor.submit(scene_information, lambda info, err: move_done(info, err, db_conn, path_index))
+            continue
         # connect to the db
         if not db_conn:
             stash_db = connect_db(STASH_DATABASE)
@@ -1161,10 +2222,11 @@ def renamer(scene_id, db_conn=None):
                 raise Exception("rename")
             # rename file on your db
             try:
-                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-                    db_rename_refactor(stash_db, scene_information)
-                else:
-                    db_rename(stash_db, scene_information)
+                with STATS.phase("database"):
+                    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                        db_rename_refactor(stash_db, scene_information)
+                    else:
+                        db_rename(stash_db, scene_information)
             except Exception as err:
                 log.LogError(f"error when trying to update the database ({err}), revert the move...")
                 err = file_rename(scene_information['final_path'], scene_information['current_path'], scene_information)
@@ -1173,11 +2235,14 @@ def renamer(scene_id, db_conn=None):
                 raise Exception("database update")
             if i == 0:
                 associated_rename(scene_information)
-            if template.get("path"):
-                if "clean_tag" in template["path"]["option"]:
-                    graphql_removeScenesTag([scene_information['scene_id']], template["path"]["opt_details"]["clean_tag"])
+            rename_done(scene_information)
         except Exception as err:
             log.LogError(f"Error during database operation ({err})")
+            STATS.count("errors")
+            if not db_conn:
+                clear_stash_info()
+            if path_index is not None and not os.path.isfile(scene_information['final_path']):
+                path_index.move(scene_id, scene_information['final_path'], scene_information['current_path'])
             if not db_conn:
                 log.LogDebug("[SQLITE] Database closed")
                 stash_db.close()
@@ -1187,10 +2252,626 @@ def renamer(scene_id, db_conn=None):
         log.LogInfo("[SQLITE] Database updated and closed!")
 
 
+def read_bulk_cursor(watermark=None):
+    # page to resume from and the source folders of the pages already done (checked for empty folders
+    # at the end of the run), an interrupted run leaves the cursor file behind.
+    # The pages depend on the watermark of the run, the cursor is only used with the same one.
+    if FRAGMENT['args'].get("cursor"):
+        return int(FRAGMENT['args']["cursor"]), []
+    if DRY_RUN or not os.path.isfile(BULK_CURSOR_FILE):
+        return 1, []
+    try:
+        with open(BULK_CURSOR_FILE, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        page, _, cursor_watermark = lines[0].strip().partition("|")
+        if (cursor_watermark or None) != watermark:
+            log.LogInfo("Ignoring the bulk cursor file, it was made for another selection of scenes")
+            return 1, []
+        return max(int(page), 1), [line for line in lines[1:] if line]
+    except (OSError, ValueError, IndexError) as err:
+        log.LogWarning(f"Ignoring the bulk cursor file ({err})")
+        return 1, []
+
+
+def write_bulk_cursor(page, watermark=None, source_dirs=()):
+    if DRY_RUN:
+        return
+    try:
+        if page is None:
+            if os.path.isfile(BULK_CURSOR_FILE):
+                os.remove(BULK_CURSOR_FILE)
+            return
+        with open(BULK_CURSOR_FILE, 'w', encoding='utf-8') as f:
+            f.write(f"{page}|{watermark or ''}")
+            for directory in sorted(source_dirs):
+                f.write(f"\n{directory}")
+    except OSError as err:
+        log.LogWarning(f"Failed to update the bulk cursor file ({err})")
+
+
+# options that change how or when the files are moved, but not their new path
+RUN_OPTIONS = {
+    "log_file", "alt_diff_display", "batch_number_scene", "bulk_page_size", "bulk_incremental", "bulk_source",
+    "db_batch_size", "move_workers", "move_crossdevice_concurrency", "remove_emptyfolder", "startup_cache_ttl",
+    "worker_mode", "worker_port", "worker_debounce", "worker_idle_timeout", "stats_summary", "stats_trace", "profile",
+    "enable_hook", "dry_run", "dry_run_append", "process_getall", "process_kill_attach"
+}
+
+
+def config_fingerprint(paths_only=False):
+    if not paths_only:
+        # the worker restarts for any change in the config
+        with open(config.__file__, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    # the bulk only checks all the scenes again when an option used for the new paths changed
+    options = []
+    for name, value in sorted(vars(config).items()):
+        if name.startswith("_") or name in RUN_OPTIONS or not isinstance(value, (str, int, float, list, tuple, dict, set, frozenset, type(None))):
+            continue
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value, key=str)
+        options.append((name, value))
+    return hashlib.sha1(repr(options).encode()).hexdigest()
+
+
+def parse_timestamp(value: str):
+    # Stash timestamps are RFC3339, the fraction of second is not needed to compare them
+    return datetime.fromisoformat(re.sub(r"\.\d+", "", value).replace("Z", "+00:00"))
+
+
+def read_bulk_state():
+    if not os.path.isfile(BULK_STATE_FILE):
+        return {}
+    try:
+        with open(BULK_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        log.LogWarning(f"Ignoring the bulk state file ({err})")
+        return {}
+
+
+def write_bulk_state(watermark: str, fingerprint: str):
+    if DRY_RUN:
+        return
+    try:
+        with open(BULK_STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"watermark": watermark, "fingerprint": fingerprint}, f)
+    except OSError as err:
+        log.LogWarning(f"Failed to update the bulk state file ({err})")
+
+
+def bulk_rename(stash_db: sqlite3.Connection):
+    path_index = load_path_index()
+    db_writer = DatabaseWriter(stash_db, DB_BATCH_SIZE)
+    executor = MoveExecutor(MOVE_WORKERS, MOVE_CROSSDEVICE_CONCURRENCY)
+    # incremental: only the scenes updated since the last complete run with the same config
+    run_start = datetime.now().astimezone().isoformat(timespec="seconds")
+    fingerprint = config_fingerprint(paths_only=True)
+    state = read_bulk_state()
+    watermark = None
+    if BULK_INCREMENTAL and "full" not in PLUGIN_ARGS and state.get("watermark"):
+        if state.get("fingerprint") == fingerprint:
+            watermark = state["watermark"]
+            log.LogInfo(f"[Bulk] Checking the scenes updated after {watermark}")
+        else:
+            log.LogInfo("[Bulk] The config changed since the last run, checking all the scenes")
+    scene_filter = None
+    if watermark:
+        scene_filter = {"updated_at": {"value": watermark, "modifier": "GREATER_THAN"}}
+    updated_at = {}
+    start_page, source_dirs = read_bulk_cursor(watermark)
+    if start_page > 1:
+        log.LogInfo(f"Resuming the bulk rename at page {start_page} (cursor: {BULK_CURSOR_FILE})")
+        executor.source_dirs.update(source_dirs)
+    limit = config.batch_number_scene
+    progress = 0
+    progress_step = None
+    scene_count = 0
+    for page, count, scenes in iter_scenes(BULK_PAGE_SIZE, start_page, scene_filter):
+        if progress_step is None:
+            total = count - (start_page - 1) * BULK_PAGE_SIZE
+            if limit >= 0:
+                total = min(total, limit)
+            log.LogDebug(f"Count scenes: {total}")
+            progress_step = 1 / max(total, 1)
+        log.LogDebug(f"[Bulk] Page {page} ({len(scenes)} scenes)")
+        for scene in scenes:
+            if 0 <= limit <= scene_count:
+                break
+            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
+            if scene.get('updated_at'):
+                updated_at[scene['id']] = scene['updated_at']
+            try:
+                renamer(scene, db_writer, path_index, executor)
+            except Exception as err:
+                log.LogError(f"main function error: {err}")
+                BULK_FAILED.add(scene['id'])
+            executor.drain()
+            scene_count += 1
+            progress += progress_step
+            log.LogProgress(progress)
+        if 0 <= limit <= scene_count:
+            break
+        # the cursor only moves when the page is moved and in the database
+        executor.drain(wait=True)
+        db_writer.flush()
+        write_bulk_cursor(page + 1, watermark, executor.source_dirs)
+    executor.shutdown()
+    executor.remove_empty_folders()
+    db_writer.flush()
+    write_bulk_cursor(None)
+    log.LogInfo(f"[Bulk] {scene_count} scenes checked")
+    if limit < 0 or scene_count < limit:
+        # complete run: the next one starts after the last scene updated, but before the failed ones
+        write_bulk_state(bulk_watermark(updated_at, run_start, watermark, start_page), fingerprint)
+
+
+def bulk_watermark(updated_at: dict, run_start: str, watermark=None, start_page=1):
+    if start_page > 1:
+        # resumed run, the first pages are not in updated_at
+        return watermark
+    failed = [parse_timestamp(updated_at[i]) for i in BULK_FAILED if i in updated_at]
+    candidates = [v for v in updated_at.values() if not failed or parse_timestamp(v) < min(failed)]
+    if not candidates:
+        return watermark
+    # a scene of a page already done can be updated during the run, with an older updated_at
+    # than the scenes of the next pages: the next run starts at the start of this one
+    return min(max(candidates, key=parse_timestamp), run_start, key=parse_timestamp)
+
+
+def plan_rename():
+    # render every scene once and write the plan file, nothing is moved
+    entries = []
+    for page, count, scenes in iter_scenes(BULK_PAGE_SIZE):
+        log.LogDebug(f"[Plan] Page {page} ({len(scenes)} scenes)")
+        for scene in scenes:
+            try:
+                for i, scene_information, template, option_dryrun in plan_renames(scene):
+                    if scene_information['final_path'] == scene_information['current_path']:
+                        status = "noop"
+                    elif check_longpath(scene_information['final_path']):
+                        status = "length"
+                    elif option_dryrun:
+                        status = "dry_run"
+                    else:
+                        status = "move"
+                    entries.append({
+                        "scene_id": scene_information['scene_id'],
+                        "file_index": i,
+                        "current_path": scene_information['current_path'],
+                        "final_path": scene_information['final_path'],
+                        "oshash": scene_information.get('oshash'),
+                        "clean_tag": scene_information.get('clean_tag'),
+                        "status": status,
+                    })
+            except Exception as err:
+                log.LogError(f"[{scene['id']}] Failed to plan the scene ({err})")
+        log.LogProgress(min(page * BULK_PAGE_SIZE / max(count, 1), 1))
+    analyse_plan(entries, load_path_index())
+    summary = {}
+    for entry in entries:
+        summary[entry["status"]] = summary.get(entry["status"], 0) + 1
+    write_plan({"plan": 1, "created": datetime.now().astimezone().isoformat('T', 'seconds'), "db_version": DB_VERSION, "summary": summary}, entries)
+    for entry in entries:
+        if entry["status"] in ("duplicate", "cycle"):
+            log.LogWarning(f"[Plan] [{entry['scene_id']}] {entry['status']}: {entry['final_path']} (used by {', '.join(entry['conflict'])})")
+    log.LogInfo(f"[Plan] {len(entries)} files: {summary} ({PLAN_FILE})")
+
+
+def analyse_plan(entries: list, path_index=None):
+    # Every check is a dict lookup on the normalized paths.
+    # duplicate: 2 files would end on the same path, the first one in the plan keeps it.
+    # step: a file can only move once the file at its destination moved away (step of that file + 1).
+    # cycle: files exchanging their paths, not handled.
+    key = os.path.normcase
+    sources = {key(entry["current_path"]): entry for entry in entries}
+    # the files of the library outside of the plan don't move
+    fixed = {}
+    if path_index is not None:
+        fixed = {path: sorted(ids) for path, ids in path_index.paths.items() if path not in sources}
+    changed = True
+    while changed:
+        # a file that can't move stays where it is and can block another one, until nothing changes
+        changed = False
+        ends = {path: [ids] for path, ids in fixed.items()}
+        for entry in entries:
+            end = entry["final_path"] if entry["status"] == "move" else entry["current_path"]
+            ends.setdefault(key(end), []).append(entry)
+        for occupants in ends.values():
+            if len(occupants) < 2:
+                continue
+            keep = next((o for o in occupants if type(o) is list or o["status"] != "move"), occupants[0])
+            for o in occupants:
+                if o is not keep and type(o) is dict and o["status"] == "move":
+                    o["status"] = "duplicate"
+                    o["conflict"] = keep if type(keep) is list else [keep["scene_id"]]
+                    changed = True
+    steps = {}
+    for entry in entries:
+        if entry["status"] != "move":
+            continue
+        chain = []
+        in_chain = set()
+        current = entry
+        while current is not None and id(current) not in steps:
+            if id(current) in in_chain:
+                # A file moving into a cycle has the destination of a file of the cycle and is already
+                # a duplicate, so the chain is the cycle itself.
+                for c in chain:
+                    c["status"] = "cycle"
+                    c["conflict"] = [current["scene_id"]]
+                chain = []
+                break
+            chain.append(current)
+            in_chain.add(id(current))
+            blocker = sources.get(key(current["final_path"]))
+            current = blocker if blocker is not None and blocker["status"] == "move" else None
+        step = steps.get(id(current), -1) if current is not None else -1
+        for c in reversed(chain):
+            step += 1
+            steps[id(c)] = c["step"] = step
+
+
+def read_plan():
+    with open(PLAN_FILE, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        entries = [json.loads(line) for line in f if line.strip()]
+    return header, entries
+
+
+def write_plan(header: dict, entries: list):
+    with open(PLAN_FILE, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + "\n")
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+
+
+def apply_plan(stash_db: sqlite3.Connection):
+    # execute a saved plan without rendering the templates again
+    if not os.path.isfile(PLAN_FILE):
+        log.LogError(f"No plan to apply, run the task 'Plan rename' first ({PLAN_FILE})")
+        return
+    header, entries = read_plan()
+    if header.get("db_version") != DB_VERSION:
+        log.LogWarning(f"The plan was made with the database version {header.get('db_version')}, the current one is {DB_VERSION}")
+    moves = sorted((entry for entry in entries if entry["status"] == "move"), key=lambda entry: entry["step"])
+    log.LogInfo(f"[Apply] {len(moves)} files to move (plan from {header.get('created')})")
+    db_writer = DatabaseWriter(stash_db, DB_BATCH_SIZE)
+    executor = MoveExecutor(MOVE_WORKERS, MOVE_CROSSDEVICE_CONCURRENCY)
+    skipped = 0
+    remaining = []
+    for index, entry in enumerate(moves):
+        if index and entry["step"] != moves[index - 1]["step"]:
+            # the next step moves into the paths freed by this one
+            executor.drain(wait=True)
+            db_writer.flush()
+        if not os.path.isfile(entry["current_path"]):
+            if os.path.isfile(entry["final_path"]):
+                log.LogDebug(f"[Apply] [{entry['scene_id']}] Already moved ({entry['final_path']})")
+            else:
+                log.LogWarning(f"[Apply] [{entry['scene_id']}] File not found ({entry['current_path']})")
+                remaining.append(entry)
+            skipped += 1
+            continue
+        if os.path.exists(entry["final_path"]):
+            log.LogWarning(f"[Apply] [{entry['scene_id']}] A file is already there ({entry['final_path']})")
+            remaining.append(entry)
+            skipped += 1
+            continue
+        scene_information = dict(entry)
+        scene_information['current_directory'], scene_information['current_filename'] = os.path.split(entry["current_path"])
+        scene_information['new_directory'], scene_information['new_filename'] = os.path.split(entry["final_path"])
+        if DRY_RUN:
+            if LOGFILE:
+                with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                    f.write(f"{entry['scene_id']}|{entry['current_path']}|{entry['final_path']}\n")
+            continue
+        executor.submit(scene_information, lambda info, err: move_done(info, err, db_writer))
+        executor.drain()
+        log.LogProgress((index + 1) / len(moves))
+    executor.shutdown()
+    executor.remove_empty_folders()
+    db_writer.flush()
+    if skipped:
+        log.LogInfo(f"[Apply] {skipped} file(s) skipped")
+    if DRY_RUN:
+        return
+    # the moves that failed (file or database) stay in the plan for the next run
+    remaining.extend(entry for entry in moves if entry["scene_id"] in BULK_FAILED)
+    if remaining:
+        write_plan(dict(header, summary={"move": len(remaining)}), remaining)
+        log.LogWarning(f"[Apply] {len(remaining)} file(s) not moved, they stay in the plan ({PLAN_FILE})")
+    else:
+        # a plan is only applied once
+        os.replace(PLAN_FILE, f"{PLAN_FILE}.done")
+        log.LogInfo(f"[Apply] Plan applied ({PLAN_FILE}.done)")
+
+
+def read_lines_backwards(path: str, block_size=1 << 16):
+    # lines of the file from the last one, the file is read by blocks from its end
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        rest = b""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b"\n")
+            # the first line can continue in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode('utf-8').rstrip("\r")
+        if rest.strip():
+            yield rest.decode('utf-8').rstrip("\r")
+
+
+def read_revert_entries(run_id=None, since=None):
+    # lines of the runs to revert, newest first: the last run, one run (run_id) or every run since a date.
+    # The lines written before the first '#RUN' marker are the run 'legacy'.
+    since_date = None
+    if since:
+        since_date = parse_timestamp(since)
+        if since_date.tzinfo is None:
+            since_date = since_date.astimezone()
+    selected = []
+    runs = []
+    lines = []
+    for line in read_lines_backwards(LOGFILE):
+        if not line.startswith("#RUN|"):
+            lines.append(line)
+            continue
+        _, marker_id, date, mode = (line.split("|") + ["", "", ""])[:4]
+        if since_date:
+            if parse_timestamp(date) < since_date:
+                break
+        elif run_id and marker_id != run_id:
+            lines = []
+            continue
+        log.LogInfo(f"[Revert] Run {marker_id} ({mode}, {date}): {len(lines)} line(s)")
+        selected.extend(lines)
+        runs.append(marker_id)
+        lines = []
+        if not since_date:
+            break
+    else:
+        if run_id == "legacy" and lines:
+            log.LogInfo(f"[Revert] Lines before the first run marker: {len(lines)}")
+            selected.extend(lines)
+            runs.append(run_id)
+    if not runs:
+        log.LogWarning("[Revert] No run found in the log file" + (f" ({run_id})" if run_id else "") + (f" since {since}" if since else ""))
+        if lines and not run_id:
+            log.LogWarning("[Revert] The log file was written by an older version, use the argument run=legacy to revert all of it")
+    moves = []
+    associated = []
+    for line in selected:
+        fields = line.split("|")
+        if len(fields) == 4:
+            moves.append(fields)
+        elif len(fields) == 3:
+            associated.append(fields)
+        else:
+            log.LogWarning(f"[Revert] Line ignored: {line}")
+    return moves, associated
+
+
+def revert_run(stash_db: sqlite3.Connection):
+    # Undo the renames of the log file, newest first: each file moves back from the new path to the old one.
+    # The files are moved by the executor and the database is updated by batch, like the task renamer.
+    if not LOGFILE or not os.path.isfile(LOGFILE):
+        log.LogError("No log file to revert, set log_file in the config")
+        return
+    moves, associated = read_revert_entries(FRAGMENT['args'].get("run"), FRAGMENT['args'].get("since"))
+    if not moves and not associated:
+        return
+    log.LogInfo(f"[Revert] {len(moves)} file(s) to move back")
+    db_writer = DatabaseWriter(stash_db, DB_BATCH_SIZE)
+    executor = MoveExecutor(MOVE_WORKERS, MOVE_CROSSDEVICE_CONCURRENCY)
+    key = os.path.normcase
+    # paths used by the moves running, a file renamed twice (or moved into a freed path) waits for them
+    busy = set()
+    skipped = 0
+    for index, (scene_id, old_path, new_path, checksum) in enumerate(moves):
+        if key(old_path) in busy or key(new_path) in busy:
+            executor.drain(wait=True)
+            db_writer.flush()
+            busy.clear()
+        if not os.path.isfile(new_path):
+            if os.path.isfile(old_path):
+                log.LogDebug(f"[Revert] [{scene_id}] Already reverted ({old_path})")
+            else:
+                log.LogWarning(f"[Revert] [{scene_id}] File not found ({new_path})")
+            skipped += 1
+            continue
+        if os.path.exists(old_path):
+            log.LogWarning(f"[Revert] [{scene_id}] A file is already there ({old_path})")
+            skipped += 1
+            continue
+        busy.update((key(old_path), key(new_path)))
+        if DRY_RUN:
+            if DRY_RUN_FILE:
+                with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
+                    f.write(f"{scene_id}|{new_path}|{old_path}\n")
+            continue
+        scene_information = {
+            "scene_id": scene_id,
+            "file_index": 0,
+            "current_path": new_path,
+            "final_path": old_path,
+            "oshash": checksum if checksum and checksum != "None" else None,
+        }
+        scene_information['current_directory'], scene_information['current_filename'] = os.path.split(new_path)
+        scene_information['new_directory'], scene_information['new_filename'] = os.path.split(old_path)
+        executor.submit(scene_information, lambda info, err: move_done(info, err, db_writer))
+        executor.drain()
+        log.LogProgress((index + 1) / len(moves))
+    executor.shutdown()
+    db_writer.flush()
+    # the associated files follow their video, only the ones left behind are moved here
+    for scene_id, old_path, new_path in associated:
+        if DRY_RUN or not os.path.isfile(new_path) or os.path.exists(old_path):
+            continue
+        try:
+            shutil.move(new_path, old_path)
+            if LOGFILE:
+                write_logfile([f"{scene_id}|{new_path}|{old_path}"])
+            log.LogInfo(f"[OS] Associate file renamed ({old_path})")
+        except Exception as err:
+            log.LogError(f"Something prevents renaming this file '{new_path}' - err: {err}")
+    executor.remove_empty_folders()
+    if skipped:
+        log.LogInfo(f"[Revert] {skipped} file(s) skipped")
+
+
+def read_worker_file():
+    try:
+        with open(WORKER_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def start_worker():
+    # same script, detached from the hook, reading the same fragment with the mode 'worker'
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    fragment = dict(FRAGMENT, args={"mode": "worker"})
+    with open(WORKER_LOG_FILE, 'a', encoding='utf-8') as worker_log:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=worker_log, **kwargs)
+    proc.stdin.write(json.dumps(fragment).encode())
+    proc.stdin.close()
+    log.LogDebug(f"[Worker] Started (pid {proc.pid})")
+
+
+def forward_to_worker(scene_id) -> bool:
+    # send the scene to the worker, start it if needed. False = the hook has to do the rename
+    message = {"scene_id": scene_id, "server_connection": FRAGMENT_SERVER, "fingerprint": config_fingerprint()}
+    started = False
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        worker = read_worker_file()
+        if worker:
+            try:
+                with socket.create_connection(("127.0.0.1", worker["port"]), timeout=2) as sock:
+                    sock.sendall((json.dumps(dict(message, token=worker["token"])) + "\n").encode())
+                    reply = sock.makefile('r', encoding='utf-8').readline().strip()
+                if reply == "ok":
+                    return True
+                log.LogDebug(f"[Worker] Scene not accepted ({reply})")
+                return False
+            except OSError:
+                pass
+        if not started:
+            start_worker()
+            started = True
+        time.sleep(0.1)
+    log.LogWarning("[Worker] Not available, the hook renames the scene")
+    return False
+
+
+def run_worker():
+    # Long-lived process used by the hook (worker_mode): it receives the scene ids on a local
+    # socket, waits worker_debounce seconds without update of a scene then renames all the
+    # ready scenes together, with one GraphQL session and one database connection.
+    try:
+        server = socket.create_server(("127.0.0.1", WORKER_PORT))
+    except OSError as err:
+        log.LogDebug(f"[Worker] Port {WORKER_PORT} not available, another worker is running ? ({err})")
+        return
+    token = secrets.token_hex(16)
+    with open(WORKER_FILE, 'w', encoding='utf-8') as f:
+        json.dump({"port": WORKER_PORT, "token": token, "pid": os.getpid()}, f)
+    fingerprint = config_fingerprint()
+    pending = {}
+    lock = threading.Lock()
+    state = {"last": time.time(), "stop": False}
+
+    def listen():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.settimeout(2)
+                    message = json.loads(conn.makefile('r', encoding='utf-8').readline())
+                    if message.get("token") != token:
+                        conn.sendall(b"denied\n")
+                        continue
+                    if message.get("fingerprint") != fingerprint or state["stop"]:
+                        # the config changed: finish the pending scenes and stop, the next hook starts a new worker
+                        state["stop"] = True
+                        conn.sendall(b"restart\n")
+                        continue
+                    with lock:
+                        FRAGMENT_SERVER.update(message["server_connection"])
+                        pending[int(message["scene_id"])] = state["last"] = time.time()
+                    conn.sendall(b"ok\n")
+                except (OSError, ValueError, KeyError) as err:
+                    log.LogDebug(f"[Worker] Bad message ({err})")
+
+    threading.Thread(target=listen, daemon=True).start()
+    log.LogInfo(f"[Worker] Listening on 127.0.0.1:{WORKER_PORT}")
+    stash_db = None
+    while True:
+        time.sleep(0.2)
+        with lock:
+            now = time.time()
+            ready = [scene_id for scene_id, updated in pending.items() if now - updated >= WORKER_DEBOUNCE]
+            for scene_id in ready:
+                del pending[scene_id]
+            stop = not pending and (state["stop"] or now - state["last"] > WORKER_IDLE_TIMEOUT)
+        if ready:
+            if stash_db is None:
+                stash_db = connect_db(STASH_DATABASE)
+            if stash_db is not None:
+                try:
+                    worker_batch(ready, stash_db)
+                except Exception as err:
+                    log.LogError(f"[Worker] Batch failed ({err})")
+                    traceback.print_exc()
+                    stash_db.close()
+                    stash_db = None
+        if stop:
+            break
+    server.close()
+    if stash_db is not None:
+        stash_db.close()
+    worker = read_worker_file()
+    if worker and worker.get("pid") == os.getpid():
+        os.remove(WORKER_FILE)
+    log.LogInfo("[Worker] Stopped")
+
+
+def worker_batch(scene_ids: list, stash_db: sqlite3.Connection):
+    # the studios can be edited while the worker is running
+    STUDIO_CACHE.clear()
+    log.LogDebug(f"[Worker] Renaming {len(scene_ids)} scene(s)")
+    for start in range(0, len(scene_ids), BULK_PAGE_SIZE):
+        ids = scene_ids[start:start + BULK_PAGE_SIZE]
+        result = graphql_findScene(len(ids), "ASC", 1, "id", scene_ids=ids)
+        for scene in result["scenes"]:
+            try:
+                renamer(scene, stash_db)
+            except Exception as err:
+                log.LogError(f"[{scene['id']}] main function error: {err}")
+
+
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
     log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
+    STATS.scene(None)
+    STATS.write()
+    if PROFILER:
+        PROFILER.disable()
+        PROFILER.dump_stats(os.path.join(PLUGIN_DIR, "renamerOnUpdate.prof"))
+        log.LogInfo(f"[Profile] Stats written in {os.path.join(PLUGIN_DIR, 'renamerOnUpdate.prof')} (python -m pstats)")
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
     sys.exit()
@@ -1198,7 +2879,7 @@ def exit_plugin(msg=None, err=None):
 
 if PLUGIN_ARGS:
     log.LogDebug("--Starting Plugin 'Renamer'--")
-    if "bulk" not in PLUGIN_ARGS:
+    if "bulk" not in PLUGIN_ARGS and PLUGIN_ARGS not in ("plan", "apply", "worker", "revert"):
         if "enable" in PLUGIN_ARGS:
             log.LogInfo("Enable hook")
             success = config_edit("enable_hook", True)
@@ -1223,17 +2904,44 @@ else:
     FRAGMENT_SCENE_ID = FRAGMENT["args"]["hookContext"]["id"]
 
 LOGFILE = config.log_file
+BULK_PAGE_SIZE = config.bulk_page_size
+DB_BATCH_SIZE = config.db_batch_size
+MOVE_WORKERS = config.move_workers
+MOVE_CROSSDEVICE_CONCURRENCY = config.move_crossdevice_concurrency
+BULK_CURSOR_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_bulk.cursor")
+BULK_STATE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_bulk.state")
+BULK_INCREMENTAL = config.bulk_incremental
+PLAN_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl")
+STARTUP_CACHE_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_startup.cache")
+STARTUP_CACHE_TTL = config.startup_cache_ttl
+BULK_SOURCE = config.bulk_source
+# bulk_source = "sqlite", set for the tasks that read all the scenes
+SCENE_READER = None
+WORKER_MODE = config.worker_mode
+WORKER_PORT = config.worker_port
+WORKER_DEBOUNCE = config.worker_debounce
+WORKER_IDLE_TIMEOUT = config.worker_idle_timeout
+WORKER_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_worker.json")
+WORKER_LOG_FILE = os.path.join(PLUGIN_DIR, "renamerOnUpdate_worker.log")
 
 #Gallery.Update.Post
 #if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
-STASH_CONFIG = graphql_getConfiguration()
-STASH_DATABASE = STASH_CONFIG['general']['databasePath']
+if not PLUGIN_ARGS and WORKER_MODE:
+    # the hook only sends the scene to the worker
+    if forward_to_worker(FRAGMENT_SCENE_ID):
+        exit_plugin("Scene sent to the worker")
+
+STASH_INFO = get_stash_info()
+STASH_DATABASE = STASH_INFO['databasePath']
+# library folders, the empty folders are removed up to them
+STASH_ROOTS = STASH_INFO.get('stashes') or []
 
 # READING CONFIG
 
 ASSOCIATED_EXT = config.associated_extension
+SIDECAR_INDEX = SidecarIndex(ASSOCIATED_EXT)
 
 FIELD_WHITESPACE_SEP = config.field_whitespaceSeperator
 FIELD_REPLACER = config.field_replacer
@@ -1272,6 +2980,8 @@ REMOVE_EMPTY_FOLDER = config.remove_emptyfolder
 
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
+# open files of the other processes, only built if a file is locked
+HANDLE_MAP = HandleMap()
 UNICODE_USE = config.use_ascii
 
 ORDER_SHORTFIELD = config.order_field
@@ -1282,7 +2992,15 @@ PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
-DB_VERSION = graphql_getBuild()
+TEMPLATE_RENDERER = TemplateRenderer(
+    field_replacer=FIELD_REPLACER,
+    prevent_title_performer=PREVENT_TITLE_PERF,
+    replace_words=FILENAME_REPLACEWORDS,
+    splitchar=FILENAME_SPLITCHAR
+)
+compile_templates()
+
+DB_VERSION = STASH_INFO['databaseSchema']
 if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
     FILE_QUERY = """
             files {
@@ -1315,24 +3033,36 @@ else:
     """
 if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
     FILE_QUERY = f"        code{FILE_QUERY}"
+SCENE_FIELDS = build_scene_fields()
 
 if PLUGIN_ARGS:
+    if BULK_SOURCE == "sqlite" and ("bulk" in PLUGIN_ARGS or PLUGIN_ARGS == "plan"):
+        SCENE_READER = SqliteSceneReader.connect(STASH_DATABASE)
     if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes['scenes'])
         stash_db = connect_db(STASH_DATABASE)
         if stash_db is None:
             exit_plugin()
-        for scene in scenes['scenes']:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
-            try:
-                renamer(scene, stash_db)
-            except Exception as err:
-                log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
+        load_studio_cache()
+        bulk_rename(stash_db)
+        stash_db.close()
+        log.LogInfo("[SQLITE] Database closed!")
+    elif PLUGIN_ARGS == "plan":
+        load_studio_cache()
+        plan_rename()
+    elif PLUGIN_ARGS == "worker":
+        run_worker()
+    elif PLUGIN_ARGS == "apply":
+        stash_db = connect_db(STASH_DATABASE)
+        if stash_db is None:
+            exit_plugin()
+        apply_plan(stash_db)
+        stash_db.close()
+        log.LogInfo("[SQLITE] Database closed!")
+    elif PLUGIN_ARGS == "revert":
+        stash_db = connect_db(STASH_DATABASE)
+        if stash_db is None:
+            exit_plugin()
+        revert_run(stash_db)
         stash_db.close()
         log.LogInfo("[SQLITE] Database closed!")
 else:
@@ -1341,5 +3071,6 @@ else:
     except Exception as err:
         log.LogError(f"main function error: {err}")
         traceback.print_exc()
+        clear_stash_info()
 
 exit_plugin("Successful!")
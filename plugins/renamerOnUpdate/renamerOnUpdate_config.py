@@ -114,14 +114,14 @@ p_tag_option = {
 #               Logging              #
 
 # File to save what is renamed, can be useful if you need to revert changes.
-# Will look like: IDSCENE|OLD_PATH|NEW_PATH
+# Will look like: IDSCENE|OLD_PATH|NEW_PATH|OSHASH, each run starts with a line #RUN|RUN_ID|DATE|MODE (used by the task 'Revert last run')
 # Leave Blank ("") or use None if you don't want to use a log file, or a working path like: C:\Users\USERNAME\.stash\plugins\Hooks\rename_log.txt
 log_file = r""
 
 ######################################
 #               Settings             #
 
-# rename associated file (subtitle, funscript) if present
+# rename associated file (subtitle, funscript) if present. The tasks also find them with a language code/subtitle flag before the extension (video.en.srt, video.pt-BR.forced.srt)
 associated_extension = ["srt", "vtt", "funscript"]
 
 # use filename as title if no title is set
@@ -149,6 +149,7 @@ field_replacer = {
 # difference between 'word' & 'any': word is between seperator (space, _, -), any is anything ('ring' would replace 'during')
 # ex:   "Scene": ["Sc.", "word"]    - Replace Scene by Sc.
 #       r"S\d+:E\d+": ["", "regex"] - Remove Sxx:Ex (x is a digit)
+# The rules are applied in this order, each one on the result of the previous one.
 replace_words = {
 }
 
@@ -190,6 +191,8 @@ prevent_title_performer = False
 # remove consecutive (/FolderName/FolderName/video.mp4 -> FolderName/video.mp4
 prevent_consecutive = True
 # check when the file has moved that the old directory is empty, if empty it will remove it.
+# Its parents that became empty are removed too, up to your library folder (Stash > Settings > Library).
+# The task renamer removes them all at the end of the run.
 remove_emptyfolder = True
 # the folder only contains 1 performer name. Else it will look the same as for filename
 path_one_performer = True
@@ -246,6 +249,40 @@ alt_diff_display = False
 
 # number of scene process by the task renamer. -1 = all scenes
 batch_number_scene = -1
+# number of scenes fetched per request by the task renamer. Lower it if the task uses too much memory.
+# If the task is interrupted, the next run resumes at the last page (renamerOnUpdate_bulk.cursor in the plugin folder)
+bulk_page_size = 500
+# only check the scenes updated since the last complete run of the task renamer (renamerOnUpdate_bulk.state in the plugin folder).
+# A change in this file checks all the scenes again, the task 'Rename scenes (full)' too.
+bulk_incremental = False
+# where the task renamer and 'Plan rename' read the scenes: "graphql" (ask Stash) or "sqlite" (read the database file of Stash,
+# faster on big libraries and no load on Stash). Needs the database version 32 (Stash v0.17) or more.
+bulk_source = "graphql"
+# number of renamed files written to the database in one transaction by the task renamer.
+db_batch_size = 100
+# number of files moved at the same time by the task renamer (renames on the same disk).
+move_workers = 8
+# number of files copied at the same time between 2 different disks by the task renamer.
+move_crossdevice_concurrency = 1
+
+# seconds the hook keeps the database path/version of Stash (renamerOnUpdate_startup.cache in the plugin folder) instead of asking for them. 0 = always ask
+startup_cache_ttl = 3600
+# The hook sends the scene to a worker process that stays in the background and renames the scenes by batch.
+# Useful when many scenes are updated at once (bulk edit, scrapers). The worker stops after worker_idle_timeout seconds without update.
+worker_mode = False
+# local port used by the hook to reach the worker (127.0.0.1 only)
+worker_port = 9998
+# seconds without a new update of a scene before the worker renames it
+worker_debounce = 2
+worker_idle_timeout = 300
+
+# write the time spent in each phase (graphql, template, move, database...) and the counters of the run (scenes renamed, skipped...)
+# in renamerOnUpdate_stats.json (plugin folder), also shown in the log.
+stats_summary = False
+# write the time spent on each scene in renamerOnUpdate_trace.jsonl (plugin folder)
+stats_trace = False
+# profile the runs with cProfile, the stats of the last run are in renamerOnUpdate.prof (plugin folder). Read them with: python -m pstats renamerOnUpdate.prof
+profile = False
 
 # disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
 enable_hook = True
@@ -260,7 +297,7 @@ dry_run_append = True
 # ! OPTIONAL module settings. Not needed for basic operation !
 
 # = psutil module (https://pypi.org/project/psutil/) =
-# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin
+# Gets all the processes using the file instead of only the first one.
 process_getall = False
 # If the file is used by a process, the plugin will kill it. IT CAN MAKE STASH CRASH TOO. 
 process_kill_attach = False
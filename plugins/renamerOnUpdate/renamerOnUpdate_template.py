@@ -0,0 +1,202 @@
+import re
+
+import log
+
+# Templates are parsed once, rendering a scene only does the replacements.
+
+RE_FIELD = re.compile(r"\$\w+")
+RE_EMPTY_GROUP = re.compile(r'\(\W*\)|\[\W*\]|{[^a-zA-Z0-9]*}')
+RE_GROUP_BRACE = re.compile(r'[{}]')
+RE_CONSECUTIVE_NONWORD = re.compile(r'(\W+)\1+')
+RE_SEPARATOR = re.compile(r'[\s_-]')
+
+# path templates with ^* create a new template per directory, don't keep them forever
+CACHE_LIMIT = 10000
+
+
+def cleanup_text(text: str):
+    # most names have no group at all, skip the regex in that case
+    if "(" in text or "[" in text or "{" in text:
+        text = RE_EMPTY_GROUP.sub('', text)
+    if "{" in text or "}" in text:
+        text = RE_GROUP_BRACE.sub('', text)
+    text = remove_consecutive_nonword(text)
+    return text.strip(" -_.")
+
+
+def remove_consecutive_nonword(text: str):
+    for _ in range(0, 10):
+        text, found = RE_CONSECUTIVE_NONWORD.subn(r'\1', text)
+        if not found:
+            break
+    return text
+
+
+class WordReplacer:
+    # replace_words compiled once. Literal 'word' rules are found with a dict lookup of the
+    # words of the name, 'any' rules with a substring test, only real regex are searched.
+    # The rules are still applied in the config order, each on the result of the previous one.
+    def __init__(self, replace_words: dict):
+        self.rules = []
+        self.word_rules = {}
+        self.any_rules = []
+        self.regex_rules = []
+        for old, new in replace_words.items():
+            if type(new) is str:
+                new = [new]
+            system = new[1] if len(new) > 1 else "word"
+            index = len(self.rules)
+            try:
+                if system == "regex":
+                    pattern = re.compile(old)
+                elif system == "word":
+                    pattern = re.compile(fr'([\s_-])({old})([\s_-])')
+            except re.error as err:
+                log.LogError(f"replace_words: invalid pattern '{old}' ({err}), ignored")
+                continue
+            if system == "regex":
+                self.regex_rules.append((index, pattern))
+                self.rules.append((old, pattern, new[0], new[0], system))
+            elif system == "word":
+                if old and re.escape(old) == old and not RE_SEPARATOR.search(old):
+                    self.word_rules.setdefault(old, index)
+                else:
+                    self.regex_rules.append((index, pattern))
+                self.rules.append((old, pattern, f'\\g<1>{new[0]}\\g<3>', new[0], system))
+            elif system == "any":
+                self.any_rules.append((index, old))
+                self.rules.append((old, None, new[0], new[0], system))
+            else:
+                log.LogWarning(f"replace_words: unknown system '{system}' for '{old}', ignored")
+
+    def matching_rules(self, text: str, after=-1):
+        # index of the rules that change something in the text
+        found = []
+        if self.word_rules:
+            # a 'word' is between 2 separators, so the first and last parts can't match
+            for word in RE_SEPARATOR.split(text)[1:-1]:
+                index = self.word_rules.get(word)
+                if index is not None and index > after:
+                    found.append(index)
+        for index, old in self.any_rules:
+            if index > after and old in text:
+                found.append(index)
+        for index, pattern in self.regex_rules:
+            if index > after and pattern.search(text):
+                found.append(index)
+        return sorted(set(found))
+
+    def replace(self, text: str):
+        found = self.matching_rules(text)
+        while found:
+            # the rules before the first match don't change anything, skip them
+            index = found[0]
+            old, pattern, repl, new, system = self.rules[index]
+            if pattern is None:
+                tmp = text.replace(old, repl)
+            else:
+                tmp = pattern.sub(repl, text)
+            if tmp != text:
+                if system == "regex":
+                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
+                else:
+                    log.LogDebug(f"'{old}' changed with '{new}'")
+                text = tmp
+                found = self.matching_rules(text, index)
+            else:
+                found = found[1:]
+        return text
+
+
+class CompiledTemplate:
+    __slots__ = ("template", "fields")
+
+    def __init__(self, template: str, field_replacer: dict):
+        self.template = template
+        field_found = RE_FIELD.findall(template)
+        # longest first, so $studio doesn't replace the start of $studio_family
+        field_found.sort(key=len, reverse=True)
+        fields = []
+        for i, token in enumerate(field_found):
+            name = token.replace("$", "").strip("_")
+            # If $performer is before $title, prevent having duplicate text.
+            performer_title = name == "performer" and len(field_found) > i + 1 and field_found[i + 1] == "$title"
+            fields.append((token, name, f"${name}", field_replacer.get(f"${name}"), performer_title))
+        self.fields = tuple(fields)
+
+
+class TemplateRenderer:
+    def __init__(self, field_replacer=None, prevent_title_performer=False, replace_words=None, splitchar=" "):
+        self._field_replacer = field_replacer or {}
+        self.prevent_title_performer = prevent_title_performer
+        self.replace_text = WordReplacer(replace_words).replace if replace_words else None
+        self.splitchar = splitchar
+        self.filename_cache = {}
+        self.path_cache = {}
+
+    def compile_filename(self, template: str) -> CompiledTemplate:
+        compiled = self.filename_cache.get(template)
+        if compiled is None:
+            if len(self.filename_cache) >= CACHE_LIMIT:
+                self.filename_cache.clear()
+            compiled = CompiledTemplate(str(template), self._field_replacer)
+            self.filename_cache[template] = compiled
+        return compiled
+
+    def compile_path(self, template: str) -> CompiledTemplate:
+        compiled = self.path_cache.get(template)
+        if compiled is None:
+            if len(self.path_cache) >= CACHE_LIMIT:
+                self.path_cache.clear()
+            compiled = CompiledTemplate(str(template).replace("$performer", "$performer_path"), self._field_replacer)
+            self.path_cache[template] = compiled
+        return compiled
+
+    def field_replacer_compiled(self, compiled: CompiledTemplate, scene_information: dict):
+        result = compiled.template
+        title = None
+        for token, name, field, replacer, performer_title in compiled.fields:
+            if performer_title and scene_information.get('performer'):
+                if scene_information.get('title') and self.prevent_title_performer:
+                    if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
+                        log.LogDebug("Ignoring the performer field because it's already in start of title")
+                        result = result.replace("$performer", "")
+                        continue
+            replaced_word = scene_information.get(name)
+            if not replaced_word:
+                replaced_word = ""
+            if replacer:
+                replaced_word = replaced_word.replace(replacer["replace"], replacer["with"])
+            if name == "title":
+                title = replaced_word.strip()
+                continue
+            if replaced_word == "":
+                result = result.replace(token, replaced_word)
+            else:
+                result = result.replace(field, replaced_word)
+        return result, title
+
+    def field_replacer(self, text: str, scene_information: dict):
+        return self.field_replacer_compiled(self.compile_filename(text), scene_information)
+
+    def filename(self, scene_information: dict, template: str) -> str:
+        r, t = self.field_replacer_compiled(self.compile_filename(template), scene_information)
+        if self.replace_text:
+            r = self.replace_text(r)
+        if not t:
+            r = r.replace("$title", "")
+        r = cleanup_text(r)
+        if t:
+            r = r.replace("$title", t)
+        # Replace spaces with splitchar
+        r = r.replace(' ', self.splitchar)
+        return r
+
+    def path(self, scene_information: dict, template: str) -> str:
+        r, t = self.field_replacer_compiled(self.compile_path(template), scene_information)
+        if not t:
+            r = r.replace("$title", "")
+        r = cleanup_text(r)
+        if t:
+            r = r.replace("$title", t)
+        return r
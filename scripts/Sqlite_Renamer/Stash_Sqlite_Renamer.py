@@ -1,34 +1,35 @@
+import argparse
+import json
 import os
 import re
 import sqlite3
 import sys
+from datetime import datetime
 
 import progressbar
 
-# Your sqlite path
+# Your sqlite path (--db)
 DB_PATH = r"C:\Users\Winter\.stash\Full.sqlite"
 # Log keep a trace of OldPath & new_path. Could be useful if you want to revert everything. Filename: rename_log.txt
 USING_LOG = True
-# DRY_RUN = True | Will don't change anything in your database & disk.
+# DRY_RUN = True | Will don't change anything in your database & disk. (--dry-run)
 DRY_RUN = False
-# Only take female performer name
+# Only take female performer name (--female-only)
 FEMALE_ONLY = False
-# Print debug message
+# Print debug message (--quiet)
 DEBUG_MODE = True
+# Number of renames in one database transaction. The pending renames of a batch are written in rename_journal.jsonl
+# before moving the files, if the script is interrupted the next run puts the database in line with the disk.
+COMMIT_BATCH = 500
+RENAME_JOURNAL = "rename_journal.jsonl"
+# Since this version (Stash 0.17), the path of a scene is in files/folders instead of scenes.path
+DB_VERSION_FILE_REFACTOR = 32
 
 def logPrint(q):
     if "[DEBUG]" in q and DEBUG_MODE == False:
         return
     print(q)
 
-logPrint("Database Path: {}".format(DB_PATH))
-if DRY_RUN == True:
-    try:
-        os.remove("rename_dryrun.txt")
-    except FileNotFoundError:
-        pass
-    logPrint("[DRY_RUN] DRY-RUN Enable")
-
 
 def gettingTagsID(name):
     cursor.execute("SELECT id from tags WHERE name=?;", [name])
@@ -42,49 +43,298 @@ def gettingTagsID(name):
     return id
 
 
-def get_SceneID_fromTags(id):
-    cursor.execute("SELECT scene_id from scenes_tags WHERE tag_id=?;", [id])
-    record = cursor.fetchall()
-    logPrint("There is {} scene(s) with the tag_id {}".format(len(record), id))
-    array_ID = []
-    for row in record:
-        array_ID.append(row[0])
-    list = ",".join(map(str, array_ID))
-    return list
-
-
-def get_Perf_fromSceneID(id_scene):
-    perf_list = ""
-    cursor.execute("SELECT performer_id from performers_scenes WHERE scene_id=?;", [id_scene])
-    record = cursor.fetchall()
-    #logPrint("Performer in scene: ", len(record))
-    if len(record) > 3:
-        logPrint("More than 3 performers.")
-    else:
-        perfcount = 0
+def get_TagCondition(id):
+    # Scenes with the tag or one of its child tags (at any depth)
+    cursor.execute("SELECT name from sqlite_master WHERE type='table' AND name='tags_relations';")
+    if cursor.fetchone() is None:
+        return "id IN (SELECT scene_id from scenes_tags WHERE tag_id=?)", [int(id)]
+    return """id IN (
+        WITH RECURSIVE tag_tree(id) AS (
+            SELECT ?
+            UNION
+            SELECT tags_relations.child_id from tags_relations JOIN tag_tree ON tags_relations.parent_id = tag_tree.id
+        )
+        SELECT scenes_tags.scene_id from scenes_tags JOIN tag_tree ON scenes_tags.tag_id = tag_tree.id
+    )""", [int(id)]
+
+
+def get_PathCondition(prefix):
+    # Files under the path, the LIKE wildcards in the path are escaped
+    pattern = re.sub(r"([!%_])", r"!\1", prefix) + "%"
+    if DB_VERSION < DB_VERSION_FILE_REFACTOR:
+        return "path LIKE ? ESCAPE '!'", [pattern]
+    return """id IN (
+        SELECT scenes_files.scene_id from scenes_files
+        JOIN files ON files.id = scenes_files.file_id
+        JOIN folders ON folders.id = files.parent_folder_id
+        WHERE scenes_files."primary" = 1 AND folders.path || ? || files.basename LIKE ? ESCAPE '!'
+    )""", [os.sep, pattern]
+
+
+def make_Query(conditions):
+    # [(condition, params)] -> ("WHERE ... AND ...", params) for edit_db
+    if len(conditions) == 0:
+        return None, []
+    params = []
+    for _, condition_params in conditions:
+        params += condition_params
+    return "WHERE " + " AND ".join(condition for condition, _ in conditions), params
+
+
+# Scene with its studio name and its performers in one query.
+# The performers are counted before the gender filter. Their names are sorted by performer id in a subquery:
+# the order of the rows given to GROUP_CONCAT is the order of that subquery (a plain join has no defined order).
+# The scenes are read by batch of SCENE_BATCH (keyset on the id), the batch is fetched before the scenes are renamed.
+# Columns: id, path, title, date, height, studio, performer count, performers, file id (DB_VERSION_FILE_REFACTOR)
+SCENE_BATCH = 1000
+SCENE_QUERY = """
+SELECT scenes.id, scenes.path, scenes.title, scenes.date, scenes.height, studios.name,
+    (SELECT COUNT(*) FROM performers_scenes WHERE performers_scenes.scene_id = scenes.id),
+    (SELECT GROUP_CONCAT(name, ' ') FROM (
+        SELECT CASE WHEN ? = 0 OR performers.gender = 'FEMALE' THEN performers.name END AS name
+        FROM performers_scenes
+        JOIN performers ON performers.id = performers_scenes.performer_id
+        WHERE performers_scenes.scene_id = scenes.id
+        ORDER BY performers_scenes.performer_id)),
+    NULL
+FROM (SELECT * FROM scenes {where}) AS scenes
+LEFT JOIN studios ON studios.id = scenes.studio_id
+WHERE scenes.id > ?
+ORDER BY scenes.id
+LIMIT ?;
+"""
+# Same with the primary file of the scene
+SCENE_QUERY_FILES = """
+SELECT scenes.id, folders.path || '{sep}' || files.basename, scenes.title, scenes.date, video_files.height, studios.name,
+    (SELECT COUNT(*) FROM performers_scenes WHERE performers_scenes.scene_id = scenes.id),
+    (SELECT GROUP_CONCAT(name, ' ') FROM (
+        SELECT CASE WHEN ? = 0 OR performers.gender = 'FEMALE' THEN performers.name END AS name
+        FROM performers_scenes
+        JOIN performers ON performers.id = performers_scenes.performer_id
+        WHERE performers_scenes.scene_id = scenes.id
+        ORDER BY performers_scenes.performer_id)),
+    files.id
+FROM (SELECT * FROM scenes {where}) AS scenes
+JOIN scenes_files ON scenes_files.scene_id = scenes.id AND scenes_files."primary" = 1
+JOIN files ON files.id = scenes_files.file_id
+JOIN folders ON folders.id = files.parent_folder_id
+LEFT JOIN video_files ON video_files.file_id = files.id
+LEFT JOIN studios ON studios.id = scenes.studio_id
+WHERE scenes.id > ?
+ORDER BY scenes.id
+LIMIT ?;
+"""
+
+
+def get_SchemaVersion():
+    cursor.execute("SELECT version from schema_migrations;")
+    return int(cursor.fetchone()[0])
+
+
+def get_Scenes(optionnal_query=None, query_params=None):
+    query = SCENE_QUERY
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        query = SCENE_QUERY_FILES
+    query = query.format(where=optionnal_query or "", sep=os.sep)
+    last_id = -1
+    while True:
+        cursor.execute(query, [FEMALE_ONLY == True] + (query_params or []) + [last_id, SCENE_BATCH])
+        record = cursor.fetchall()
+        if len(record) == 0:
+            return
+        last_id = record[-1][0]
         for row in record:
-            perf_id = str(row[0])
-            cursor.execute("SELECT name,gender from performers WHERE id=?;", [perf_id])
-            perf = cursor.fetchall()
-            if FEMALE_ONLY == True:
-                # Only take female gender
-                if str(perf[0][1]) == "FEMALE":
-                    perf_list += str(perf[0][0]) + " "
-                    perfcount += 1
-                else:
-                    continue
-            else:
-                perf_list += str(perf[0][0]) + " "
-                perfcount += 1
-    perf_list = perf_list.strip()
-    return perf_list
+            yield row
+
 
+def get_Basename(path):
+    # Key of the duplicate check: the path can use / or \, the comparison is case insensitive (Windows)
+    return re.split(r"[\\/]", path)[-1].lower()
 
-def get_Studio_fromID(id):
-    cursor.execute("SELECT name from studios WHERE id=?;", [id])
-    record = cursor.fetchall()
-    studio_name = str(record[0][0])
-    return studio_name
+
+def get_FilenameIndex():
+    # basename -> scene ids, built once and kept updated with the renames (planned renames in DRY_RUN)
+    index = {}
+    if DB_VERSION < DB_VERSION_FILE_REFACTOR:
+        cursor.execute("SELECT id,path from scenes;")
+    else:
+        cursor.execute("SELECT scenes_files.scene_id, files.basename from scenes_files JOIN files ON files.id = scenes_files.file_id;")
+    for row in cursor:
+        index.setdefault(get_Basename(row[1]), set()).add(row[0])
+    return index
+
+
+def update_FilenameIndex(scene_id, old_path, new_path):
+    old_ids = filename_index.get(get_Basename(old_path))
+    if old_ids is not None:
+        old_ids.discard(scene_id)
+    filename_index.setdefault(get_Basename(new_path), set()).add(scene_id)
+
+
+def get_FolderIDs():
+    # folder path -> id, loaded once (DB_VERSION_FILE_REFACTOR)
+    cursor.execute("SELECT id,path from folders;")
+    return {row[1]: row[0] for row in cursor}
+
+
+def create_Folders(paths, mod_time):
+    # Insert the folders missing in the database, with their missing parents, in one statement.
+    # Returns the folders created, they are added to folder_ids.
+    new_folders = set()
+    for path in set(paths):
+        chain = []
+        folder = path
+        while folder not in folder_ids and folder not in new_folders:
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                # Not under a folder of Stash, the files going there will fail
+                chain = []
+                break
+            chain.append(folder)
+            folder = parent
+        new_folders.update(chain)
+    if len(new_folders) == 0:
+        return []
+    cursor.execute("SELECT MAX(id) from folders;")
+    folder_id = (cursor.fetchone()[0] or 0) + 1
+    rows = []
+    created = {}
+    # The parents first
+    for folder in sorted(new_folders, key=len):
+        created[folder] = folder_id
+        parent = os.path.dirname(folder)
+        rows.append([folder_id, folder, created.get(parent, folder_ids.get(parent)), mod_time, mod_time, mod_time])
+        folder_id += 1
+    cursor.executemany("INSERT INTO folders (id, path, parent_folder_id, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?);", rows)
+    folder_ids.update(created)
+    logPrint("[SQLITE] {} folder(s) created".format(len(rows)))
+    return list(created)
+
+
+def get_ScenePath(scene_id, file_id):
+    if DB_VERSION < DB_VERSION_FILE_REFACTOR:
+        cursor.execute("SELECT path from scenes WHERE id=?;", [scene_id])
+    else:
+        cursor.execute("SELECT folders.path || ? || files.basename from files JOIN folders ON folders.id = files.parent_folder_id WHERE files.id=?;", [os.sep, file_id])
+    result = cursor.fetchone()
+    if result is None:
+        return None
+    return result[0]
+
+
+def update_ScenePath(scene_id, file_id, new_path, mod_time):
+    if DB_VERSION < DB_VERSION_FILE_REFACTOR:
+        cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [new_path, scene_id])
+        return
+    folder_id = folder_ids.get(os.path.dirname(new_path))
+    if folder_id is None:
+        raise ValueError("The folder {} is not in your database (not in a library of Stash ?)".format(os.path.dirname(new_path)))
+    cursor.execute("UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;", [os.path.basename(new_path), folder_id, mod_time, file_id])
+
+
+def write_RenameLog(scene_id, current_path, new_path):
+    if rename_log is not None:
+        print("{}|{}|{}\n".format(scene_id, current_path, new_path), file=rename_log)
+
+
+def apply_Renames(batch):
+    # batch: [(scene_id, file_id, current_path, new_path)], the filename index has the new paths already
+    if len(batch) == 0:
+        return
+    with open(RENAME_JOURNAL, "w", encoding="utf-8") as journal:
+        for scene_id, file_id, current_path, new_path in batch:
+            journal.write(json.dumps({"id": scene_id, "file": file_id, "old": current_path, "new": new_path}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    renamed = []
+    mod_time = datetime.now().astimezone().isoformat('T', 'seconds')
+    cursor.execute("BEGIN;")
+    for scene_id, file_id, current_path, new_path in batch:
+        # One file failing only rolls back its own row, and the folders created for it
+        cursor.execute("SAVEPOINT rename_file;")
+        new_folders = []
+        try:
+            # os.rename overwrites the destination on POSIX (only a case change can be the same file)
+            if os.path.exists(new_path) and not os.path.samefile(current_path, new_path):
+                raise FileExistsError("A file already exists at the new path ({})".format(new_path))
+            if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                new_folders = create_Folders([os.path.dirname(new_path)], mod_time)
+            update_ScenePath(scene_id, file_id, new_path, mod_time)
+            os.rename(current_path, new_path)
+            success = os.path.isfile(new_path)
+        except (OSError, sqlite3.Error, ValueError) as error:
+            logPrint("[Error] {}".format(error))
+            success = False
+        if success:
+            cursor.execute("RELEASE rename_file;")
+            renamed.append((scene_id, current_path, new_path))
+            logPrint("[OS] File Renamed! ({})".format(os.path.basename(current_path)))
+        else:
+            cursor.execute("ROLLBACK TO rename_file;")
+            cursor.execute("RELEASE rename_file;")
+            for folder in new_folders:
+                del folder_ids[folder]
+            update_FilenameIndex(scene_id, new_path, current_path)
+            logPrint("[OS] File failed to rename ? ({})".format(os.path.basename(current_path)))
+            print("{} -> {}\n".format(current_path, new_path), file=open("renamer_fail.txt", "a", encoding='utf-8'))
+    sqliteConnection.commit()
+    logPrint("[SQLITE] Datebase Updated! ({} scenes)".format(len(renamed)))
+    for scene_id, current_path, new_path in renamed:
+        write_RenameLog(scene_id, current_path, new_path)
+    if rename_log is not None:
+        rename_log.flush()
+    os.remove(RENAME_JOURNAL)
+
+
+def reconcile_Journal():
+    # The last run was interrupted during a batch, the database takes the path where the file is on the disk.
+    if not os.path.isfile(RENAME_JOURNAL):
+        return
+    if DRY_RUN == True:
+        logPrint("[DRY_RUN][Journal] The last run was interrupted, run without DRY_RUN to check its pending renames")
+        return
+    logPrint("[Journal] The last run was interrupted, checking its pending renames ({})".format(RENAME_JOURNAL))
+    mod_time = datetime.now().astimezone().isoformat('T', 'seconds')
+    logged = set()
+    if rename_log is not None and os.path.isfile("rename_log.txt"):
+        with open("rename_log.txt", encoding="utf-8") as log_file:
+            logged = set(line.rstrip("\n") for line in log_file)
+    with open(RENAME_JOURNAL, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Interrupted while writing the journal, no file of this batch was moved
+                continue
+            db_path = get_ScenePath(entry["id"], entry.get("file"))
+            if db_path is None:
+                continue
+            old_exists = os.path.isfile(entry["old"])
+            new_exists = os.path.isfile(entry["new"])
+            if new_exists and not old_exists:
+                disk_path = entry["new"]
+                log_line = "{}|{}|{}".format(entry["id"], entry["old"], entry["new"])
+                if log_line not in logged:
+                    write_RenameLog(entry["id"], entry["old"], entry["new"])
+            elif old_exists and not new_exists:
+                disk_path = entry["old"]
+            else:
+                logPrint("[Journal] [{}] Can't find which file is the scene: {} -> {}".format(entry["id"], entry["old"], entry["new"]))
+                print("{} -> {}\n".format(entry["old"], entry["new"]), file=open("renamer_fail.txt", "a", encoding='utf-8'))
+                continue
+            if db_path != disk_path:
+                try:
+                    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+                        create_Folders([os.path.dirname(disk_path)], mod_time)
+                    update_ScenePath(entry["id"], entry.get("file"), disk_path, mod_time)
+                except ValueError as error:
+                    logPrint("[Journal] [{}] {}".format(entry["id"], error))
+                    continue
+                logPrint("[Journal] [{}] Database updated: {}".format(entry["id"], disk_path))
+    sqliteConnection.commit()
+    if rename_log is not None:
+        rename_log.flush()
+    os.remove(RENAME_JOURNAL)
 
 
 def makeFilename(scene_info, query):
@@ -131,19 +381,17 @@ def makeFilename(scene_info, query):
     return new_filename
 
 
-def edit_db(query_filename, optionnal_query=None):
-    query = "SELECT id,path,title,date,studio_id,height from scenes;"
-    if optionnal_query is not None:
-        query = "SELECT id,path,title,date,studio_id,height from scenes {};".format(optionnal_query)
-    cursor.execute(query)
-    record = cursor.fetchall()
-    if len(record) == 0:
+def edit_db(query_filename, optionnal_query=None, query_params=None):
+    cursor.execute("SELECT COUNT(*) from scenes {};".format(optionnal_query or ""), query_params or [])
+    scene_count = cursor.fetchone()[0]
+    if scene_count == 0:
         logPrint("[Warn] There is no scene to change with this query")
         return
-    logPrint("Scenes numbers: {}".format(len(record)))
+    logPrint("Scenes numbers: {}".format(scene_count))
     progressbar_Index = 0
-    progress = progressbar.ProgressBar(redirect_stdout=True).start(len(record))
-    for row in record:
+    progress = progressbar.ProgressBar(redirect_stdout=True).start(scene_count)
+    pending_renames = []
+    for row in get_Scenes(optionnal_query, query_params):
         progress.update(progressbar_Index + 1)
         progressbar_Index += 1
         scene_ID = str(row[0])
@@ -154,16 +402,19 @@ def edit_db(query_filename, optionnal_query=None):
         file_extension = os.path.splitext(current_path)[1]
         scene_title = str(row[2])
         scene_date = str(row[3])
-        scene_Studio_id = str(row[4])
-        file_height = str(row[5])
+        file_height = str(row[4])
         # By default, title contains extensions.
         scene_title = re.sub(file_extension + '$', '', scene_title)
 
-        performer_name = get_Perf_fromSceneID(scene_ID)
+        performer_name = ""
+        if row[6] > 3:
+            logPrint("More than 3 performers.")
+        elif row[7] is not None:
+            performer_name = row[7]
 
         studio_name = ""
-        if (scene_Studio_id and scene_Studio_id != "None"):
-            studio_name = get_Studio_fromID(scene_Studio_id)
+        if row[5] is not None:
+            studio_name = str(row[5])
 
         if file_height == '4320':
             file_height = '8k'
@@ -210,12 +461,11 @@ def edit_db(query_filename, optionnal_query=None):
                 continue
 
         # Looking for duplicate filename
-        cursor.execute("SELECT id FROM scenes WHERE path LIKE ? AND NOT id=?;", ["%" + new_filename, scene_ID])
-        dupl_check = cursor.fetchall()
+        dupl_check = sorted(filename_index.get(get_Basename(new_filename), set()) - {row[0]})
         if len(dupl_check) > 0:
-            for dupl_row in dupl_check:
-                logPrint("[Error] Same filename: [{}]".format(dupl_row[0]))
-                logPrint("[{}] - {}\n".format(dupl_row[0], new_filename),
+            for dupl_id in dupl_check:
+                logPrint("[Error] Same filename: [{}]".format(dupl_id))
+                print("[{}] - {}\n".format(dupl_id, new_filename),
                       file=open("renamer_duplicate.txt", "a", encoding='utf-8'))
             logPrint("\n")
             continue
@@ -232,44 +482,29 @@ def edit_db(query_filename, optionnal_query=None):
             # Windows Rename
             if (os.path.isfile(current_path) == True):
                 if DRY_RUN == False:
-                    os.rename(current_path, new_path)
-                    if (os.path.isfile(new_path) == True):
-                        logPrint("[OS] File Renamed! ({})".format(current_filename))
-                        if USING_LOG == True:
-                            print("{}|{}|{}\n".format(scene_ID, current_path, new_path), file=open("rename_log.txt", "a", encoding='utf-8'))
-
-                        # Database rename
-                        cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [new_path, scene_ID])
-                        sqliteConnection.commit()
-                        logPrint("[SQLITE] Datebase Updated!")
-                    else:
-                        logPrint("[OS] File failed to rename ? ({})".format(current_filename))
-                        print("{} -> {}\n".format(current_path,new_path), file=open("renamer_fail.txt", "a", encoding='utf-8'))
+                    # File & database rename, by batch
+                    pending_renames.append((row[0], row[8], current_path, new_path))
+                    update_FilenameIndex(row[0], current_path, new_path)
+                    if len(pending_renames) >= COMMIT_BATCH:
+                        apply_Renames(pending_renames)
+                        pending_renames = []
                 else:
                     logPrint("[DRY_RUN][OS] File should be renamed")
+                    update_FilenameIndex(row[0], current_path, new_path)
                     print("{} -> {}\n".format(current_path, new_path), file=open("renamer_dryrun.txt", "a", encoding='utf-8'))
             else:
                 logPrint("[OS] File don't exist in your Disk/Drive ({})".format(current_path))
             logPrint("\n")
         # break
     progress.finish()
-    if DRY_RUN == False:
-        sqliteConnection.commit()
+    apply_Renames(pending_renames)
     return
 
 
-try:
-    sqliteConnection = sqlite3.connect(DB_PATH)
-    cursor = sqliteConnection.cursor()
-    logPrint("Python successfully connected to SQLite\n")
-except sqlite3.Error as error:
-    logPrint("FATAL SQLITE Error: ", error)
-    input("Press Enter to continue...")
-    sys.exit(1)
-
 # THIS PART IS PERSONAL THINGS, YOU SHOULD CHANGE THING BELOW :)
+# (used when the script is run without --tag/--all/--path-prefix)
 
-# Select Scene with Specific Tags
+# Select Scene with Specific Tags (--tag TAG TEMPLATE)
 tags_dict = {
     '1': {
         'tag': '!1. JAV',
@@ -284,26 +519,74 @@ tags_dict = {
         'filename': '$date $performer - $title [$studio]'
     }
 }
+# Only the files under this path (--path-prefix), "" for all the files
+PATH_PREFIX = "E:\\Film\\R18\\"
+
+# END OF PERSONAL THINGS
 
-for _, dict_section in tags_dict.items():
-    tag_name = dict_section.get("tag")
-    filename_template = dict_section.get("filename")
+parser = argparse.ArgumentParser(description="Rename the files of Stash using the metadata of its database (sqlite).")
+parser.add_argument("--db", default=DB_PATH, help="path of the Stash database (default: DB_PATH)")
+parser.add_argument("--tag", nargs=2, action="append", metavar=("TAG", "TEMPLATE"),
+                    help="rename the scenes with TAG or one of its child tags using TEMPLATE, can be repeated (default: tags_dict)")
+parser.add_argument("--all", metavar="TEMPLATE", help="rename all the scenes using TEMPLATE")
+parser.add_argument("--path-prefix", default=PATH_PREFIX, help='only rename the files under this path, "" for all the files (default: PATH_PREFIX)')
+parser.add_argument("--dry-run", action="store_true", default=DRY_RUN, help="don't change the database and the files")
+parser.add_argument("--female-only", action="store_true", default=FEMALE_ONLY, help="only use the female performers for $performer")
+parser.add_argument("--quiet", action="store_true", default=not DEBUG_MODE, help="don't print the debug messages")
+args = parser.parse_args()
+DB_PATH = args.db
+DRY_RUN = args.dry_run
+FEMALE_ONLY = args.female_only
+DEBUG_MODE = not args.quiet
+tag_templates = args.tag
+if tag_templates is None:
+    tag_templates = []
+    if args.all is None:
+        tag_templates = [(dict_section.get("tag"), dict_section.get("filename")) for dict_section in tags_dict.values()]
+
+logPrint("Database Path: {}".format(DB_PATH))
+if DRY_RUN == True:
+    try:
+        os.remove("rename_dryrun.txt")
+    except FileNotFoundError:
+        pass
+    logPrint("[DRY_RUN] DRY-RUN Enable")
+
+try:
+    sqliteConnection = sqlite3.connect(DB_PATH)
+    cursor = sqliteConnection.cursor()
+    logPrint("Python successfully connected to SQLite\n")
+    DB_VERSION = get_SchemaVersion()
+    logPrint("Database version: {}".format(DB_VERSION))
+    if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+        folder_ids = get_FolderIDs()
+    rename_log = None
+    if USING_LOG == True and DRY_RUN == False:
+        rename_log = open("rename_log.txt", "a", encoding='utf-8')
+    reconcile_Journal()
+    filename_index = get_FilenameIndex()
+except sqlite3.Error as error:
+    logPrint("FATAL SQLITE Error: {}".format(error))
+    sys.exit(1)
+
+path_conditions = []
+if args.path_prefix:
+    path_conditions.append(get_PathCondition(args.path_prefix))
+
+for tag_name, filename_template in tag_templates:
     id_tags = gettingTagsID(tag_name)
     if id_tags is not None:
-        id_scene = get_SceneID_fromTags(id_tags)
-        option_sqlite_query = "WHERE id in ({}) AND path LIKE 'E:\\Film\\R18\\%'".format(id_scene)
-        edit_db(filename_template, option_sqlite_query)
+        option_sqlite_query, query_params = make_Query([get_TagCondition(id_tags)] + path_conditions)
+        edit_db(filename_template, option_sqlite_query, query_params)
         logPrint("====================")
 
 # Select ALL scenes
-#edit_db("$date $performer - $title [$studio]")
-
-# END OF PERSONAL THINGS
+if args.all is not None:
+    option_sqlite_query, query_params = make_Query(path_conditions)
+    edit_db(args.all, option_sqlite_query, query_params)
 
-if DRY_RUN == False:
-    sqliteConnection.commit()
 cursor.close()
 sqliteConnection.close()
+if rename_log is not None:
+    rename_log.close()
 logPrint("The SQLite connection is closed")
-# Input if you want to check the console.
-input("Press Enter to continue...")